@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from pathlib import Path
+
+# one JSON record per line: {"type": "package", "metadata": {...}} for each
+# package and {"type": "file", "repo": ..., "package": ..., "version": ...,
+# "path": ..., "size": ..., "sha1": ..., "mtime_ns": ...} for each file, where
+# sha1, size and mtime_ns describe the file as it was written to disk
+MANIFEST_NAME = "manifest.jsonl"
+LISTING_KEYS = ("repo", "package", "version", "path", "size", "sha1")
+
+
+def manifest_path(root):
+    return Path(root) / MANIFEST_NAME
+
+
+def read_manifest(root):
+    # returns (files, package_metadata), or None for a backup made before
+    # manifests were written
+    path = manifest_path(root)
+    if not path.exists():
+        return None
+    files = []
+    package_metadata = []
+    with path.open() as manifest:
+        for line in manifest:
+            record = json.loads(line)
+            if record.pop("type") == "package":
+                package_metadata.append(record["metadata"])
+            else:
+                files.append(record)
+    return files, package_metadata
+
+
+def recorded_packages(manifest):
+    # (repo, package name) -> (package information, {version: file listing})
+    # as the backup last saw them. only versions with files are included, a
+    # filtered backup records the information of versions it did not list
+    if manifest is None:
+        return {}
+    files, package_metadata = manifest
+    packages = {
+        (package["repo"], package["name"]): (package, {}) for package in package_metadata
+    }
+    for record in files:
+        package = packages.get((record["repo"], record["package"]))
+        if package is not None:
+            package[1].setdefault(record["version"], []).append(
+                {key: record[key] for key in LISTING_KEYS}
+            )
+    return packages
+
+
+def file_record(bintray_file, path, sha1):
+    stat = path.stat()
+    return {
+        "repo": bintray_file["repo"],
+        "package": bintray_file["package"],
+        "version": bintray_file["version"],
+        "path": bintray_file["path"],
+        "size": stat.st_size,
+        "sha1": sha1,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def is_unchanged(record, path):
+    # a file whose size and mtime still match its record is trusted to still
+    # have the recorded sha1, so it does not need to be read and hashed again
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    return stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]
+
+
+def write_manifest(root, repositories, files, package_metadata, package_filter=None):
+    # records for repositories that were not part of this backup are kept, as
+    # are those of packages and versions a package filter left out of it
+    previous_files, previous_package_metadata = read_manifest(root) or ([], [])
+    filtered = package_filter is not None and not package_filter.selects_everything
+    backed_up = {(package["repo"], package["name"]) for package in package_metadata}
+
+    def is_replaced(repository, package_name):
+        if repository not in repositories:
+            return False
+        return not filtered or (repository, package_name) in backed_up
+
+    files = [
+        record
+        for record in previous_files
+        if not is_replaced(record["repo"], record["package"])
+        or (filtered and not package_filter.includes_version(record["version"]))
+    ] + files
+    package_metadata = [
+        package
+        for package in previous_package_metadata
+        if not is_replaced(package["repo"], package["name"])
+    ] + package_metadata
+
+    path = manifest_path(root)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(f"{MANIFEST_NAME}.partial")
+    with partial_path.open(mode="w") as manifest:
+        for package in package_metadata:
+            manifest.write(json.dumps({"type": "package", "metadata": package}) + "\n")
+        for record in files:
+            manifest.write(json.dumps({"type": "file", **record}) + "\n")
+    os.replace(partial_path, path)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from .progress import progress
+
+
+class TokenBucket:
+    # a byte budget shared by every transfer worker. rate is in bytes per
+    # second, None meaning unlimited, and may be changed at any time.
+    # a caller that takes more than is available goes into debt and waits
+    # for it to be paid off, so one large read cannot starve the others
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.rate = None
+        self.burst = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        check_rate(rate)
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            # by default up to one second of unused budget can be saved up
+            self.burst = burst if burst is not None else rate
+            if rate is not None:
+                self.tokens = min(self.tokens, self.burst)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+        self.updated = now
+
+    def reserve(self, amount):
+        # takes amount from the budget, returning how long to wait before
+        # the bytes may be transferred
+        if self.rate is None:
+            return 0
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+
+    def consume(self, amount):
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+
+def check_rate(rate):
+    # a rate of 0 would never let a byte through, unlimited is None
+    if rate is not None and rate <= 0:
+        raise ValueError(f"a byte rate must be positive, not {rate}")
+
+
+class BandwidthLimiter:
+    # separate budgets for bytes coming in (downloads) and going out (uploads)
+    def __init__(self, ingress_rate=None, egress_rate=None):
+        self.ingress = TokenBucket(ingress_rate)
+        self.egress = TokenBucket(egress_rate)
+
+    def set_rates(self, ingress_rate=None, egress_rate=None):
+        # both are checked first, so a bad rate changes neither limit
+        check_rate(ingress_rate)
+        check_rate(egress_rate)
+        self.ingress.set_rate(ingress_rate)
+        self.egress.set_rate(egress_rate)
+
+    def follow(self, path, interval=5):
+        # re-reads {"ingress": bytes/s, "egress": bytes/s} from path every
+        # interval seconds so the limits can be changed while a run is going
+        def watch():
+            last_modified = None
+            while True:
+                try:
+                    modified = os.stat(path).st_mtime_ns
+                    if modified != last_modified:
+                        rates = json.loads(Path(path).read_text())
+                        self.set_rates(rates.get("ingress"), rates.get("egress"))
+                        last_modified = modified
+                except (OSError, ValueError) as e:
+                    progress.log(f"could not read bandwidth limits from {path}: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=watch, daemon=True).start()
+        return self
+
+
+class ThrottledReader:
+    # file-like wrapper that takes every read from a token bucket
+    def __init__(self, stream, size, bucket):
+        self.stream = stream
+        self.size = size
+        self.bucket = bucket
+
+    def __len__(self):
+        return self.size
+
+    def read(self, amount=-1):
+        data = self.stream.read(amount)
+        self.bucket.consume(len(data))
+        return data
+
+
+def throttled_chunks(chunks, bucket):
+    for chunk in chunks:
+        bucket.consume(len(chunk))
+        yield chunk
+
+
+def bandwidth_from_environment():
+    def rate(name):
+        value = os.environ.get(name)
+        return int(value) if value else None
+
+    bandwidth = BandwidthLimiter(
+        rate("BINTRAY_MAX_DOWNLOAD_RATE"), rate("BINTRAY_MAX_UPLOAD_RATE")
+    )
+    if os.environ.get("BINTRAY_RATE_FILE"):
+        bandwidth.follow(os.environ["BINTRAY_RATE_FILE"])
+    return bandwidth
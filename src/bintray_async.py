@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+from .backup_manifest import file_record
+from .backup_manifest import read_manifest
+from .backup_manifest import write_manifest
+from .bandwidth import bandwidth_from_environment
+from .bintray_async_client import AsyncBintrayClient
+from .bintray_async_client import DEFAULT_MAX_IN_FLIGHT
+from .bintray_backup import existing_copy
+from .bintray_backup import write_package_metadata
+from .bintray_backup import DEFAULT_REPOSITORIES as DEFAULT_BACKUP_REPOSITORIES
+from .bintray_client import local_path
+from .bintray_client import repositories_from_environment
+from .bintray_restore import check_dirs_exist
+from .bintray_restore import get_local_files
+from .bintray_restore import get_local_sha1s
+from .bintray_restore import is_changed
+from .bintray_restore import missing_packages
+from .bintray_restore import DEFAULT_REPOSITORIES as DEFAULT_RESTORE_REPOSITORIES
+from .progress import progress
+from .tracing import tracing_from_environment
+
+
+async def run_blocking(function, *args):
+    # hashing and directory walks run on the default thread pool so they do
+    # not stall the requests in flight on the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+async def download_if_changed(bintray_client, root, file, recorded_files):
+    path, record = await run_blocking(existing_copy, root, file, recorded_files)
+    if record is not None:
+        return False, record
+    sha1 = await bintray_client.download_file(
+        path, bintray_client.download_url(file["repo"], file["path"])
+    )
+    return True, file_record(file, path, sha1)
+
+
+async def backup(
+    username,
+    token,
+    organisation,
+    repositories=DEFAULT_BACKUP_REPOSITORIES,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    root=Path("."),
+    bandwidth=None,
+    **client_options,
+):
+    root = Path(root)
+    async with AsyncBintrayClient(
+        organisation,
+        username,
+        token,
+        max_in_flight,
+        bandwidth=bandwidth,
+        **client_options,
+    ) as bintray_client:
+        if repositories is None:
+            repositories = await bintray_client.get_repository_names()
+        all_files, package_metadata = await bintray_client.get_metadata(repositories)
+        progress.log(f"There are {len(all_files)} files")
+        # written ahead of the files, as the threaded backup does
+        for package in package_metadata:
+            write_package_metadata(root, package)
+
+        manifest = read_manifest(root)
+        recorded_files = {
+            local_path(record): record for record in (manifest or ([], []))[0]
+        }
+        results = await asyncio.gather(
+            *(
+                download_if_changed(bintray_client, root, file, recorded_files)
+                for file in all_files
+            )
+        )
+    progress.log(
+        f"Skipped {sum(not downloaded for downloaded, _ in results)} already downloaded files"
+    )
+
+    progress.log("Writing manifest")
+    write_manifest(
+        root, set(repositories), [record for _, record in results], package_metadata
+    )
+    progress.log("Done!")
+
+
+async def upload_if_changed(bintray_client, path, bintray_sha1s, root, local_sha1s):
+    if not await run_blocking(is_changed, path, bintray_sha1s, root, local_sha1s):
+        return False
+    await bintray_client.upload_file(path, local_root=root)
+    return True
+
+
+async def restore(
+    username,
+    token,
+    organisation,
+    repositories=DEFAULT_RESTORE_REPOSITORIES,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    root=Path("."),
+    bandwidth=None,
+    **client_options,
+):
+    root = Path(root)
+    async with AsyncBintrayClient(
+        organisation,
+        username,
+        token,
+        max_in_flight,
+        bandwidth=bandwidth,
+        **client_options,
+    ) as bintray_client:
+        if repositories is None:
+            repositories = [
+                name
+                for name in await bintray_client.get_repository_names()
+                if (root / name).exists()
+            ]
+        check_dirs_exist(repositories, root)
+
+        manifest = read_manifest(root)
+        (local_files, local_package_metadata), (
+            bintray_files,
+            bintray_package_metadata,
+        ) = await asyncio.gather(
+            run_blocking(get_local_files, repositories, root, manifest),
+            bintray_client.get_metadata(repositories),
+        )
+
+        new_packages = missing_packages(local_package_metadata, bintray_package_metadata)
+        await asyncio.gather(
+            *(
+                bintray_client.create_package(package["repo"], package)
+                for package in new_packages
+            )
+        )
+        progress.log(
+            f"created {len(new_packages)} packages, skipped {len(local_package_metadata) - len(new_packages)} packages that already existed"
+        )
+
+        bintray_sha1s = {
+            local_path(bintray_file): bintray_file["sha1"]
+            for bintray_file in bintray_files
+        }
+        local_sha1s = await run_blocking(get_local_sha1s, root, manifest)
+        uploaded_files = sum(
+            await asyncio.gather(
+                *(
+                    upload_if_changed(
+                        bintray_client, path, bintray_sha1s, root, local_sha1s
+                    )
+                    for path in local_files
+                )
+            )
+        )
+    progress.log(
+        f"uploaded {uploaded_files} files, skipped {len(local_files) - uploaded_files} files that already existed"
+    )
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] # 'backup' or 'restore'
+    username = os.environ["BINTRAY_USERNAME"]
+    token = os.environ["BINTRAY_TOKEN"]
+    organisation = os.environ["BINTRAY_ORGANISATION"]
+    max_in_flight = int(os.environ.get("BINTRAY_MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT))
+    tracing_from_environment()
+    if command == "backup":
+        repositories = repositories_from_environment(DEFAULT_BACKUP_REPOSITORIES)
+        asyncio.run(backup(username, token, organisation, repositories, max_in_flight, bandwidth=bandwidth_from_environment()))
+    else:
+        repositories = repositories_from_environment(DEFAULT_RESTORE_REPOSITORIES)
+        asyncio.run(restore(username, token, organisation, repositories, max_in_flight, bandwidth=bandwidth_from_environment()))
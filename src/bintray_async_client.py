@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+from pathlib import Path
+
+import aiohttp
+
+from .bandwidth import BandwidthLimiter
+from .bintray_client import new_package_metadata
+from .bintray_client import BINTRAY_API_URL
+from .bintray_client import BINTRAY_DL_URL
+from .bintray_client import CHUNK_SIZE
+from .bintray_client import MAX_REQUEST_ATTEMPTS
+from .bintray_client import RETRY_STATUS_CODES
+from .tracing import traced
+
+DEFAULT_MAX_IN_FLIGHT = 200
+
+
+class AsyncBintrayClient:
+    # the same operations as BintrayClient on a single event loop, so hundreds
+    # of metadata and small file requests can be in flight without a thread
+    # each. use it as an async context manager so its connections are closed
+    def __init__(
+        self,
+        organisation,
+        username,
+        token,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        api_url=BINTRAY_API_URL,
+        dl_url=BINTRAY_DL_URL,
+        bandwidth=None,
+    ):
+        self.organisation = organisation
+        self.api_creds = aiohttp.BasicAuth(username, token)
+        self.max_in_flight = max_in_flight
+        self.api_url = api_url
+        self.dl_url = dl_url
+        self.bandwidth = bandwidth if bandwidth is not None else BandwidthLimiter()
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            auth=self.api_creds,
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+            raise_for_status=True,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def retrying(self, send):
+        # send makes the request afresh, it is awaited again with the same
+        # backoff as BintrayClient.request when the request is throttled, fails
+        # on the server or loses its connection
+        for attempt in range(1, MAX_REQUEST_ATTEMPTS + 1):
+            try:
+                return await send()
+            except aiohttp.ClientResponseError as e:
+                if e.status not in RETRY_STATUS_CODES or attempt == MAX_REQUEST_ATTEMPTS:
+                    raise
+                retry_after = (e.headers or {}).get("Retry-After")
+            except aiohttp.ClientError:
+                if attempt == MAX_REQUEST_ATTEMPTS:
+                    raise
+                retry_after = None
+            await asyncio.sleep(
+                float(retry_after) if retry_after else min(2 ** attempt / 4, 30)
+            )
+
+    async def get_json(self, url):
+        async def send():
+            async with self.session.get(url) as response:
+                return await response.json(content_type=None), response.headers
+
+        return await self.retrying(send)
+
+    @traced("get_repository_names")
+    async def get_repository_names(self):
+        repositories, _ = await self.get_json(
+            f"{self.api_url}/repos/{self.organisation}/"
+        )
+        return [repository["name"] for repository in repositories]
+
+    @traced("get_package_names")
+    async def get_package_names(self, repository):
+        discovered_packages = []
+        packages_api = (
+            f"{self.api_url}/repos/{self.organisation}/{repository}/packages?start_pos="
+        )
+        start_pos = 0
+        while True:
+            packages, headers = await self.get_json(f"{packages_api}{start_pos}")
+            discovered_packages.extend(package["name"] for package in packages)
+            if "X-RangeLimit-EndPos" not in headers:
+                break
+            if int(headers["X-RangeLimit-EndPos"]) + 1 == int(
+                headers["X-RangeLimit-Total"]
+            ):
+                break
+            start_pos = int(headers["X-RangeLimit-EndPos"]) + 1
+        return discovered_packages
+
+    @traced("get_package_information")
+    async def get_package_information(self, package_name, repository):
+        information, _ = await self.get_json(
+            f"{self.api_url}/packages/{self.organisation}/{repository}/{package_name}"
+        )
+        return information
+
+    @traced("get_package_files")
+    async def get_package_files(self, repository, package_name):
+        files, _ = await self.get_json(
+            f"{self.api_url}/packages/{self.organisation}/{repository}/{package_name}/files"
+        )
+        return files
+
+    @traced("get_package_metadata")
+    async def get_package_metadata(self, repository, package_name):
+        return await asyncio.gather(
+            self.get_package_information(package_name, repository),
+            self.get_package_files(repository, package_name),
+        )
+
+    async def get_metadata(self, repositories):
+        all_files = []
+        package_metadata = []
+        package_names = await asyncio.gather(
+            *(self.get_package_names(repository) for repository in repositories)
+        )
+        for information, files in await asyncio.gather(
+            *(
+                self.get_package_metadata(repository, package)
+                for repository, names in zip(repositories, package_names)
+                for package in names
+            )
+        ):
+            package_metadata.append(information)
+            all_files.extend(files)
+        return all_files, package_metadata
+
+    def download_url(self, repository, path):
+        return f"{self.dl_url}/{self.organisation}/{repository}/{path}"
+
+    @traced("download_file")
+    async def download_file(self, path, url):
+        async def send():
+            sha1 = hashlib.sha1()
+            async with self.session.get(url) as response:
+                with path.open(mode="wb") as f:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await asyncio.sleep(self.bandwidth.ingress.reserve(len(chunk)))
+                        sha1.update(chunk)
+                        f.write(chunk)
+            return sha1.hexdigest()
+
+        return await self.retrying(send)
+
+    async def throttled_file_chunks(self, path):
+        loop = asyncio.get_running_loop()
+        with path.open(mode="rb") as data:
+            while True:
+                chunk = await loop.run_in_executor(None, data.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                await asyncio.sleep(self.bandwidth.egress.reserve(len(chunk)))
+                yield chunk
+
+    @traced("upload_file")
+    async def upload_file(self, path, local_root=Path(".")):
+        # the file is read again from the start for each attempt
+        local_file = local_root / path
+        size = local_file.stat().st_size
+        await self.retrying(
+            lambda: self.upload(path, self.throttled_file_chunks(local_file), size)
+        )
+
+    async def upload(self, path, data, size):
+        async with self.session.put(
+            f"{self.api_url}/content/{self.organisation}/{path}?publish=1&override=1",
+            data=data,
+            headers={"Content-Length": str(size)},
+        ):
+            pass
+
+    @traced("create_package")
+    async def create_package(self, repository, local_metadata):
+        async def send():
+            async with self.session.post(
+                f"{self.api_url}/packages/{self.organisation}/{repository}",
+                json=new_package_metadata(local_metadata),
+            ) as response:
+                return await response.json(content_type=None)
+
+        return await self.retrying(send)
@@ -2,56 +2,243 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
-from progress.bar import IncrementalBar
 
+from .backup_manifest import file_record
+from .backup_manifest import is_unchanged
+from .backup_manifest import read_manifest
+from .backup_manifest import recorded_packages
+from .backup_manifest import write_manifest
+from .bandwidth import bandwidth_from_environment
+from .bandwidth import BandwidthLimiter
 from .bintray_client import BintrayClient
+from .bintray_client import create_session
+from .bintray_client import iter_crawl
 from .bintray_client import get_sha1_hash
-from .bintray_client import PROGRESS_BAR_FORMAT
+from .bintray_client import local_path
+from .bintray_client import map_with
+from .bintray_client import progress_bar
+from .bintray_client import repositories_from_environment
+from .bintray_client import BINTRAY_API_URL
+from .bintray_client import BINTRAY_DL_URL
+from .bintray_client import DEFAULT_MAX_WORKERS
+from .package_filter import package_filter_from_environment
+from .progress import progress
+from .tracing import tracer
+from .tracing import tracing_from_environment
 
+# repositories = ["releases", "sbt-plugin-releases"]
+DEFAULT_REPOSITORIES = ["sbt-plugin-releases"]
 
-def backup(username, token, organisation):
-    # repositories = ["releases", "sbt-plugin-releases"]
-    repositories = ["sbt-plugin-releases"]
+
+def backup(
+    username,
+    token,
+    organisation,
+    repositories=DEFAULT_REPOSITORIES,
+    max_workers=DEFAULT_MAX_WORKERS,
+    max_requests_per_organisation=None,
+    bandwidth=None,
+    api_url=BINTRAY_API_URL,
+    dl_url=BINTRAY_DL_URL,
+    package_filter=None,
+    incremental=False,
+):
+    backup_organisations(
+        username,
+        token,
+        {organisation: Path(".")},
+        repositories,
+        max_workers,
+        max_requests_per_organisation,
+        bandwidth=bandwidth,
+        api_url=api_url,
+        dl_url=dl_url,
+        package_filter=package_filter,
+        incremental=incremental,
+    )
+
+
+def backup_organisations(
+    username,
+    token,
+    organisations,
+    repositories=DEFAULT_REPOSITORIES,
+    max_workers=DEFAULT_MAX_WORKERS,
+    max_requests_per_organisation=None,
+    bandwidth=None,
+    api_url=BINTRAY_API_URL,
+    dl_url=BINTRAY_DL_URL,
+    package_filter=None,
+    incremental=False,
+):
+    # organisations is either a list of names, each backed up into a directory
+    # of the same name, or a dict of organisation name -> backup directory.
+    # repositories=None backs up every repository of each organisation.
+    # package_filter limits the backup to some packages and versions.
+    # incremental reuses the previous backup's listings of versions that
+    # cannot have changed, see BintrayClient.get_package_metadata
+    if not isinstance(organisations, dict):
+        organisations = {organisation: Path(organisation) for organisation in organisations}
     bintray_api_creds = requests.auth.HTTPBasicAuth(username, token)
-    bintray_client = BintrayClient(organisation, api_creds=bintray_api_creds)
-
-    all_files, package_metadata = bintray_client.get_metadata(repositories)
-    print(f"There are {len(all_files)} files")
-    skipped_files = 0
-    with IncrementalBar(
-        "Downloading files", max=len(all_files), suffix=PROGRESS_BAR_FORMAT
-    ) as bar:
-        for index, file in enumerate(all_files, start=1):
-            path = Path(
-                f"{file['repo']}/{file['package']}/{file['version']}/{file['path']}"
+    session = create_session(max_workers)
+    bandwidth = bandwidth if bandwidth is not None else BandwidthLimiter()
+    clients = {
+        organisation: BintrayClient(
+            organisation,
+            api_creds=bintray_api_creds,
+            session=session,
+            max_in_flight=max_requests_per_organisation,
+            bandwidth=bandwidth,
+            api_url=api_url,
+            dl_url=dl_url,
+            package_filter=package_filter,
+        )
+        for organisation in organisations
+    }
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if repositories is None:
+            organisation_repositories = map_with(
+                executor,
+                lambda client: client.get_repository_names(),
+                clients.values(),
+            )
+        else:
+            organisation_repositories = [repositories] * len(clients)
+        jobs = [
+            (client, repository)
+            for client, names in zip(clients.values(), organisation_repositories)
+            for repository in names
+        ]
+        # the previous manifest says which local files can be trusted without
+        # hashing them again
+        manifests = {
+            organisation: read_manifest(root) for organisation, root in organisations.items()
+        }
+        previous = (
+            {
+                organisation: recorded_packages(manifest)
+                for organisation, manifest in manifests.items()
+            }
+            if incremental
+            else None
+        )
+        recorded_files = {
+            organisation: {
+                local_path(record): record for record in (manifest or ([], []))[0]
+            }
+            for organisation, manifest in manifests.items()
+        }
+
+        # a package's files start downloading as their records are parsed from
+        # its listing, the crawl only keeps a pool's worth of packages queued
+        # ahead of them
+        metadata = {client.organisation: ([], []) for client, _ in jobs}
+        downloads = []
+        with tracer.span("crawl", "phase"):
+            for client, information, files in iter_crawl(
+                jobs, executor, previous, window=max_workers
+            ):
+                all_files, package_metadata = metadata[client.organisation]
+                package_metadata.append(information)
+                # written ahead of the package's files, so a restore watching
+                # the tree can create the package from it when they land
+                write_package_metadata(organisations[client.organisation], information)
+                # each file is queued as soon as its record has been parsed
+                for file in files:
+                    all_files.append(file)
+                    downloads.append(
+                        (
+                            client,
+                            executor.submit(
+                                download_if_changed,
+                                client,
+                                Path(organisations[client.organisation]),
+                                file,
+                                recorded_files[client.organisation],
+                            ),
+                        )
+                    )
+        progress.log(f"There are {len(downloads)} files")
+        skipped_files = 0
+        file_records = {organisation: [] for organisation in metadata}
+        with tracer.span("download", "phase"), progress_bar(
+            "Downloading files", len(downloads), "in"
+        ) as bar:
+            for client, download in downloads:
+                downloaded, record = download.result()
+                if not downloaded:
+                    skipped_files += 1
+                file_records[client.organisation].append(record)
+                bar.next()
+        progress.log(f"Skipped {skipped_files} already downloaded files")
+
+    progress.log("Writing manifest")
+    with tracer.phase("write"):
+        for organisation, (_, package_metadata) in metadata.items():
+            write_manifest(
+                organisations[organisation],
+                {repository for client, repository in jobs if client.organisation == organisation},
+                file_records[organisation],
+                package_metadata,
+                package_filter,
             )
-            if path.exists() and (get_sha1_hash(path) == file["sha1"]):
-                skipped_files += 1
-            else:
-                # print(f"downloading {index}/{len(all_files)}")
-                path.parent.mkdir(parents=True, exist_ok=True)
-                bintray_client.download_file(
-                    path,
-                    f"https://dl.bintray.com/{organisation}/{file['repo']}/{file['path']}",
-                )
-            bar.next()
-    print(f"Skipped {skipped_files} already downloaded files")
-
-    print("Writing package_metadata")
-    for package in package_metadata:
-        path = Path(f"{package['repo']}/{package['name']}/package_metadata.json")
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open(mode="w") as pm:
-            json.dump(package, pm)
-
-    print("Done!")
+
+    progress.log("Done!")
+
+
+def write_package_metadata(root, package):
+    path = Path(root, f"{package['repo']}/{package['name']}/package_metadata.json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open(mode="w") as pm:
+        json.dump(package, pm)
+
+
+def existing_copy(root, file, recorded_files):
+    # returns (path, record), record being None when the file needs to be
+    # downloaded into path. a local copy is only hashed when its manifest
+    # record cannot be trusted
+    path = root / local_path(file)
+    record = recorded_files.get(local_path(file))
+    if record is not None and is_unchanged(record, path):
+        if record["sha1"] == file["sha1"]:
+            return path, record
+    elif path.exists():
+        sha1 = get_sha1_hash(path)
+        if sha1 == file["sha1"]:
+            return path, file_record(file, path, sha1)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path, None
+
+
+def download_if_changed(bintray_client, root, file, recorded_files):
+    path, record = existing_copy(root, file, recorded_files)
+    if record is not None:
+        return False, record
+    sha1 = bintray_client.download_file(
+        path,
+        bintray_client.download_url(file["repo"], file["path"]),
+    )
+    return True, file_record(file, path, sha1)
 
 
 if __name__ == "__main__":
     username = os.environ["BINTRAY_USERNAME"]
     token = os.environ["BINTRAY_TOKEN"]
-    organisation = os.environ["BINTRAY_ORGANISATION"] #e.g. 'hmrc' or 'hmrc-digital'
-    backup(username, token, organisation)
+    organisations = os.environ["BINTRAY_ORGANISATION"].split(",") #e.g. 'hmrc' or 'hmrc,hmrc-digital'
+    repositories = repositories_from_environment(DEFAULT_REPOSITORIES)
+    max_workers = int(os.environ.get("BINTRAY_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    max_requests = os.environ.get("BINTRAY_MAX_REQUESTS_PER_ORGANISATION")
+    max_requests = int(max_requests) if max_requests else None
+    bandwidth = bandwidth_from_environment()
+    package_filter = package_filter_from_environment()
+    incremental = os.environ.get("BINTRAY_INCREMENTAL") == "1"
+    tracing_from_environment()
+    if len(organisations) == 1:
+        backup(username, token, organisations[0], repositories, max_workers, max_requests, bandwidth, package_filter=package_filter, incremental=incremental)
+    else:
+        backup_organisations(username, token, organisations, repositories, max_workers, max_requests, bandwidth, package_filter=package_filter, incremental=incremental)
@@ -1,44 +1,382 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import codecs
+import hashlib
+import io
 import json
+import itertools
 import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from pathlib import Path
 
 import requests
-from progress.bar import IncrementalBar
+from requests.adapters import HTTPAdapter
 from tenacity import retry
+from tenacity import retry_if_exception
+from tenacity import stop_after_attempt
 
-PROGRESS_BAR_FORMAT = "%(percent).1f%% - remaining %(remaining)d - eta %(eta)ds"
+from .bandwidth import BandwidthLimiter
+from .bandwidth import ThrottledReader
+from .bandwidth import throttled_chunks
+from .package_filter import PackageFilter
+from .progress import progress
+from .tracing import traced
+from .tracing import tracer
+
+BINTRAY_API_URL = "https://bintray.com/api/v1"
+BINTRAY_DL_URL = "https://dl.bintray.com"
+DEFAULT_MAX_WORKERS = 8
+CHUNK_SIZE = 64 * 1024
+MAX_REQUEST_ATTEMPTS = 5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# file records a listing may parse ahead of the crawl taking them
+LISTING_BUFFER = 1024
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def is_retryable(exception):
+    # a lost connection, throttling, a server error or a corrupted transfer,
+    # not a refused request or a local file that cannot be read
+    if isinstance(exception, ChecksumMismatch):
+        return True
+    if not isinstance(exception, requests.RequestException):
+        return False
+    response = exception.response
+    return response is None or response.status_code in RETRY_STATUS_CODES
+
+
+def wait_for_retry_after(retry_state):
+    # as long as a throttled response asks, otherwise the backoff request()
+    # uses
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after is not None:
+        return float(retry_after)
+    return min(2 ** retry_state.attempt_number / 4, 30)
+
+
+# a transfer whose body is a stream cannot be retried by request(), the whole
+# transfer is retried from the start a bounded number of times instead
+retry_transfer = retry(
+    stop=stop_after_attempt(MAX_REQUEST_ATTEMPTS),
+    wait=wait_for_retry_after,
+    retry=retry_if_exception(is_retryable),
+    reraise=True,
+)
 
 
 def get_sha1_hash(path):
     pathstr = str(path)
-    stream = os.popen(f"sha1sum {pathstr}")
-    return stream.read().split(" ")[0]
+    with tracer.span("sha1", "hash", path=pathstr):
+        stream = os.popen(f"sha1sum {pathstr}")
+        return stream.read().split(" ")[0]
+
+
+def progress_bar(message, total, transfer=None):
+    # next() only bumps a counter, the progress renderer draws it. transfer
+    # is "in" or "out" for a phase that should show the bytes moved
+    return progress.phase(message, total, transfer)
+
+
+def local_path(bintray_file):
+    return f"{bintray_file['repo']}/{bintray_file['package']}/{bintray_file['version']}/{bintray_file['path']}"
+
+
+def new_package_metadata(local_metadata):
+    metadata = {
+        "name": local_metadata["name"],
+        "licenses": ["Apache-2.0"],
+        "vcs_url": local_metadata.get("vcs_url", "https://github.com/hmrc"),
+        "desc": local_metadata.get("desc"),
+        "labels": local_metadata.get("labels"),
+        "website_url": local_metadata.get("website_url"),
+        "issue_tracker_url": local_metadata.get("issue_tracker_url"),
+        "github_repo": local_metadata.get("github_repo"),
+        "github_release_notes_file": local_metadata.get("github_release_notes_file"),
+    }
+    if metadata["vcs_url"] is None:
+        metadata["vcs_url"] = "https://github.com/hmrc"
+    return metadata
+
+
+def repositories_from_environment(default):
+    # unset means the default repositories, "*" means all of them
+    repositories = os.environ.get("BINTRAY_REPOSITORIES")
+    if repositories is None:
+        return default
+    if repositories.strip() == "*":
+        return None
+    return [repository.strip() for repository in repositories.split(",")]
+
+
+def create_session(max_workers=DEFAULT_MAX_WORKERS):
+    # one connection pool shared by every worker (and every organisation) so
+    # keep-alive connections are reused rather than opened per request
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def map_with(executor, function, items):
+    if executor is None:
+        return map(function, items)
+    return executor.map(function, items)
+
+
+def iter_crawl(jobs, executor=None, previous=None, window=None):
+    # yields (client, package information, files) for each package as soon
+    # as its information has been fetched. files is an iterator over the
+    # package's file records, which are listed on a thread of their own from
+    # the moment the information arrives and handed over as they are parsed,
+    # so it must be iterated exactly once. jobs are (client, repository)
+    # pairs and every request is its own task, so the repositories of several organisations
+    # share the same worker budget. each client's package filter drops
+    # packages by name before any of them is requested. previous is
+    # organisation -> recorded_packages of the last backup, for an
+    # incremental crawl that only lists new and changed versions. window
+    # caps the packages queued on the executor at once, leaving room for
+    # the caller to queue work for the packages already yielded
+    previous = previous or {}
+    package_names = list(
+        map_with(executor, lambda job: job[0].get_package_names(job[1]), jobs)
+    )
+    packages = [
+        (client, repository, package)
+        for (client, repository), names in zip(jobs, package_names)
+        for package in names
+        if client.package_filter.includes_package(package)
+    ]
+
+    def fetch(package):
+        client, repository, package_name = package
+        information, files = client.iter_package_metadata(
+            repository,
+            package_name,
+            previous.get(client.organisation, {}).get((repository, package_name)),
+        )
+        if files is not None and executor is not None:
+            files = stream_on_thread(files)
+        return information, files
+
+    if executor is None:
+        results = ((package[0], fetch(package)) for package in packages)
+    else:
+        results = submit_in_window(executor, fetch, packages, window or len(packages))
+    with progress_bar("Downloading package information", len(packages)) as bar:
+        for client, (information, files) in results:
+            bar.next()
+            if files is not None:
+                yield client, information, files
+
+
+def stream_on_thread(items, buffer=LISTING_BUFFER):
+    # iterates items on a thread of its own and yields each one as soon as it
+    # has been produced, so the caller can act on a listing's first records
+    # while the rest are still being parsed. the listing does not queue behind
+    # the work the caller submits for its records, and runs at most buffer
+    # items ahead of the caller
+    handover = queue.Queue(maxsize=buffer)
+    abandoned = threading.Event()
+
+    def hand_over(entry):
+        while not abandoned.is_set():
+            try:
+                handover.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill():
+        try:
+            with tracer.span("list_files"):
+                for item in items:
+                    if not hand_over((False, item)):
+                        return
+        except Exception as e:
+            hand_over((True, e))
+        else:
+            hand_over((True, None))
+
+    def drain():
+        try:
+            while True:
+                done, item = handover.get()
+                if done:
+                    if item is not None:
+                        raise item
+                    return
+                yield item
+        finally:
+            abandoned.set()
+
+    threading.Thread(target=fill, daemon=True).start()
+    return drain()
+
+
+def submit_in_window(executor, fetch, packages, window):
+    pending = deque()
+    for package in packages:
+        pending.append((package[0], executor.submit(fetch, package)))
+        if len(pending) >= window:
+            client, future = pending.popleft()
+            yield client, future.result()
+    while pending:
+        client, future = pending.popleft()
+        yield client, future.result()
+
+
+def crawl_metadata(jobs, executor=None, previous=None):
+    # the whole crawl, keyed by organisation
+    results = {client.organisation: ([], []) for client, _ in jobs}
+    for client, information, files in iter_crawl(jobs, executor, previous):
+        all_files, package_metadata = results[client.organisation]
+        package_metadata.append(information)
+        all_files.extend(files)
+    return results
+
+
+def iter_json_array(chunks):
+    # yields the items of a JSON array from the chunks of its body as they
+    # arrive, so neither the whole body nor an object graph for all of it is
+    # held at once. an item is only taken once the comma or bracket after it
+    # has arrived, otherwise a number split across two chunks is cut short
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        index = 0
+        while True:
+            while index < len(buffer) and buffer[index] in " \t\r\n,":
+                index += 1
+            if index == len(buffer):
+                break
+            if not started:
+                if buffer[index] != "[":
+                    raise ValueError("expected a JSON array")
+                started = True
+                index += 1
+                continue
+            if buffer[index] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                break
+            separator = end
+            while separator < len(buffer) and buffer[separator] in " \t\r\n":
+                separator += 1
+            if separator == len(buffer) or buffer[separator] not in ",]":
+                break
+            yield item
+            index = end
+        buffer = buffer[index:]
+    raise ValueError("truncated JSON array")
+
+
+class HashingReader:
+    # file-like wrapper that sha1s whatever is read through it, so a body can
+    # be streamed into a request and checked without a second pass over it.
+    # requests takes the Content-Length from __len__ instead of chunking, so
+    # no more than size bytes are read even if the file grows meanwhile
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.size = size
+        self.remaining = size
+        self.sha1 = hashlib.sha1()
+
+    def __len__(self):
+        return self.size
+
+    def read(self, amount=-1):
+        if amount is None or amount < 0 or amount > self.remaining:
+            amount = self.remaining
+        data = self.stream.read(amount) if amount else b""
+        self.remaining -= len(data)
+        self.sha1.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
 
 
 class BintrayClient:
-    def __init__(self, organisation, api_creds):
+    def __init__(
+        self,
+        organisation,
+        api_creds,
+        session=None,
+        max_in_flight=None,
+        bandwidth=None,
+        api_url=BINTRAY_API_URL,
+        dl_url=BINTRAY_DL_URL,
+        package_filter=None,
+    ):
         self.api_creds = api_creds
         self.organisation = organisation
+        self.api_url = api_url
+        self.dl_url = dl_url
+        self.session = session if session is not None else requests.Session()
+        # shared between clients so the byte rate limits apply to the whole run
+        self.bandwidth = bandwidth if bandwidth is not None else BandwidthLimiter()
+        # caps the requests this organisation has in flight across all workers
+        self.in_flight = (
+            threading.BoundedSemaphore(max_in_flight)
+            if max_in_flight
+            else nullcontext()
+        )
+        self.package_filter = (
+            package_filter if package_filter is not None else PackageFilter()
+        )
 
+    def request(self, method, url, **kwargs):
+        # throttled and failed requests are retried with a backoff, unless
+        # their body is a stream that cannot be sent a second time
+        attempts = 1 if "data" in kwargs else MAX_REQUEST_ATTEMPTS
+        for attempt in range(1, attempts + 1):
+            with self.in_flight:
+                response = self.session.request(
+                    method, url, auth=self.api_creds, **kwargs
+                )
+            if response.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+                return response
+            response.close()
+            time.sleep(
+                float(response.headers.get("Retry-After", min(2 ** attempt / 4, 30)))
+            )
+
+    @traced("get_repository_names")
     def get_repository_names(self):
-        response = requests.get(
-            f"https://bintray.com/api/v1/repos/{self.organisation}/",
-            auth=self.api_creds,
+        response = self.request(
+            "GET", f"{self.api_url}/repos/{self.organisation}/"
         )
         response.raise_for_status()
         repository_names = map(lambda repository: repository["name"], response.json())
         return list(repository_names)
 
+    @traced("get_package_names")
     def get_package_names(self, repository):
         discovered_packages = []
-        packages_api = f"https://bintray.com/api/v1/repos/{self.organisation}/{repository}/packages?start_pos="
+        packages_api = f"{self.api_url}/repos/{self.organisation}/{repository}/packages?start_pos="
         start_pos = 0
         while True:
-            print(f"getting package names: {start_pos}")
-            response = requests.get(f"{packages_api}{start_pos}", auth=self.api_creds)
-            response.raise_for_status()
-            discovered_packages.extend([package["name"] for package in response.json()])
+            with self.request("GET", f"{packages_api}{start_pos}", stream=True) as response:
+                response.raise_for_status()
+                discovered_packages.extend(
+                    package["name"]
+                    for package in iter_json_array(response.iter_content(CHUNK_SIZE))
+                )
             # print(response.headers)
             if "X-RangeLimit-EndPos" not in response.headers:
                 break
@@ -47,12 +385,16 @@ class BintrayClient:
             ):
                 break
             start_pos = int(response.headers["X-RangeLimit-EndPos"]) + 1
+        progress.log(
+            f"listed {len(discovered_packages)} packages in {self.organisation}/{repository}"
+        )
         return discovered_packages
 
+    @traced("get_package_information")
     def get_package_information(self, package_name, repository):
-        response = requests.get(
-            f"https://bintray.com/api/v1/packages/{self.organisation}/{repository}/{package_name}",
-            auth=self.api_creds,
+        response = self.request(
+            "GET",
+            f"{self.api_url}/packages/{self.organisation}/{repository}/{package_name}",
         )
         response.raise_for_status()
         return response.json()
@@ -61,65 +403,174 @@ class BintrayClient:
         with open(f"{file_path}/package_metadata.json", "w") as pm:
             json.dump(package_information, pm)
 
+    def iter_json(self, url):
+        # listings are streamed and parsed as they arrive. requests asks for
+        # a gzip or deflate response by default and iter_content inflates it
+        with self.request("GET", url, stream=True) as response:
+            response.raise_for_status()
+            yield from iter_json_array(response.iter_content(CHUNK_SIZE))
+
+    def iter_package_files(self, repository, package_name):
+        return self.iter_json(
+            f"{self.api_url}/packages/{self.organisation}/{repository}/{package_name}/files"
+        )
+
+    def iter_version_files(self, repository, package_name, version):
+        return self.iter_json(
+            f"{self.api_url}/packages/{self.organisation}/{repository}/{package_name}/versions/{version}/files"
+        )
+
+    @traced("get_package_files")
     def get_package_files(self, repository, package_name):
-        files_response = requests.get(
-            f"https://bintray.com/api/v1/packages/{self.organisation}/{repository}/{package_name}/files",
-            auth=self.api_creds,
+        return list(self.iter_package_files(repository, package_name))
+
+    @traced("get_version_files")
+    def get_version_files(self, repository, package_name, version):
+        return list(self.iter_version_files(repository, package_name, version))
+
+    @traced("get_package_metadata")
+    def get_package_metadata(self, repository, package_name, previous=None):
+        # files is None when the package was not updated since the filter's
+        # date. with a version filter only the selected versions are listed.
+        # previous is (information, {version: files}) from the last backup,
+        # whose listings are reused for versions that cannot have changed
+        information, files = self.iter_package_metadata(
+            repository, package_name, previous
         )
-        files_response.raise_for_status()
-        return files_response.json()
+        return information, None if files is None else list(files)
 
-    @retry
+    def iter_package_metadata(self, repository, package_name, previous=None):
+        # as get_package_metadata, except that files is an iterator and the
+        # listings are only requested as it is iterated
+        information = self.get_package_information(package_name, repository)
+        if not self.package_filter.includes_updated(information):
+            return information, None
+        versions = [
+            version
+            for version in information.get("versions", [])
+            if self.package_filter.includes_version(version)
+        ]
+        unchanged_versions = set()
+        if previous is not None:
+            previous_information, previous_files = previous
+            unchanged_versions = set(versions) & set(previous_files)
+            if previous_information.get("updated") != information.get("updated"):
+                # files are almost always published into the newest version,
+                # older versions are only listed again by a full crawl
+                unchanged_versions.discard(previous_information.get("latest_version"))
+        changed_versions = [
+            version for version in versions if version not in unchanged_versions
+        ]
+        if not unchanged_versions and not self.package_filter.filters_versions:
+            return information, self.iter_package_files(repository, package_name)
+        return (
+            information,
+            itertools.chain(
+                (
+                    file
+                    for version in versions
+                    if version in unchanged_versions
+                    for file in previous_files[version]
+                ),
+                (
+                    file
+                    for version in changed_versions
+                    for file in self.iter_version_files(repository, package_name, version)
+                ),
+            ),
+        )
+
+    def download_url(self, repository, path):
+        return f"{self.dl_url}/{self.organisation}/{repository}/{path}"
+
+    def open_download(self, url):
+        response = self.request("GET", url, stream=True)
+        response.raise_for_status()
+        return response
+
+    @traced("download_file")
+    @retry_transfer
     def download_file(self, path, url):
-        with requests.get(url, auth=self.api_creds) as r:
+        sha1 = hashlib.sha1()
+        with self.request("GET", url, stream=True) as r:
             r.raise_for_status()
             with path.open(mode="wb") as f:
-                f.write(r.content)
-
-    @retry
-    def upload_file(self, path):
-        response = requests.put(
-            f"https://bintray.com/api/v1/content/{self.organisation}/{path}?publish=1&override=1",
-            auth=self.api_creds,
-            data=path.read_bytes(),
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    self.bandwidth.ingress.consume(len(chunk))
+                    progress.transferred("in", len(chunk))
+                    sha1.update(chunk)
+                    f.write(chunk)
+        return sha1.hexdigest()
+
+    @traced("upload_file")
+    @retry_transfer
+    def upload_file(self, path, local_root=Path(".")):
+        # the body is read from the file a block at a time as it is sent, so
+        # an upload holds one block in memory whatever the size of the file.
+        # returns the sha1 of what was sent, hashed from the same reads
+        with (local_root / path).open(mode="rb") as data:
+            body = HashingReader(data, os.fstat(data.fileno()).st_size)
+            self.upload(path, body)
+        return body.hexdigest()
+
+    @traced("upload")
+    def upload(self, path, data, publish=True):
+        # data is bytes or a sized file-like object. an unpublished upload is
+        # not visible until its version is published
+        size = len(data)
+        if isinstance(data, bytes):
+            data = io.BytesIO(data)
+        data = ThrottledReader(data, size, self.bandwidth.egress)
+        response = self.request(
+            "PUT",
+            f"{self.api_url}/content/{self.organisation}/{path}?publish={int(publish)}&override=1",
+            data=data,
         )
         response.raise_for_status()
+        progress.transferred("out", size)
 
-    def get_metadata(self, repositories):
-        all_files = []
-        package_metadata = []
-        for repository in repositories:
-            package_names = self.get_package_names(repository)
-            for package in IncrementalBar(
-                f"Downloading '{repository}' package information",
-                suffix=PROGRESS_BAR_FORMAT,
-            ).iter(package_names):
-                package_metadata.append(
-                    self.get_package_information(package, repository)
-                )
-                all_files.extend(self.get_package_files(repository, package))
-        return all_files, package_metadata
+    @traced("publish_version")
+    def publish_version(self, repository, package_name, version):
+        response = self.request(
+            "POST",
+            f"{self.api_url}/content/{self.organisation}/{repository}/{package_name}/{version}/publish",
+        )
+        response.raise_for_status()
+
+    @traced("delete_file")
+    def delete_file(self, repository, path):
+        response = self.request(
+            "DELETE", f"{self.api_url}/content/{self.organisation}/{repository}/{path}"
+        )
+        response.raise_for_status()
+
+    @traced("upload_archive")
+    def upload_archive(self, repository, package_name, version, data):
+        # bintray unpacks the archive into the version, entries are paths
+        # relative to the repository root
+        response = self.request(
+            "PUT",
+            f"{self.api_url}/content/{self.organisation}/{repository}/{package_name}/{version}/{version}.zip?publish=1&override=1&explode=1",
+            data=throttled_chunks(progress.counted(data, "out"), self.bandwidth.egress),
+        )
+        response.raise_for_status()
+
+    def get_metadata(self, repositories, executor=None):
+        jobs = [(self, repository) for repository in repositories]
+        return crawl_metadata(jobs, executor).get(self.organisation, ([], []))
 
+    def iter_metadata(self, repositories, executor=None, window=None):
+        # yields (package information, files) for each package as it is fetched
+        jobs = [(self, repository) for repository in repositories]
+        for _, information, files in iter_crawl(jobs, executor, window=window):
+            yield information, list(files)
+
+    @traced("create_package")
     def create_package(self, repository, local_metadata):
-        metadata = {
-            "name": local_metadata["name"],
-            "licenses": ["Apache-2.0"],
-            "vcs_url": local_metadata.get("vcs_url", "https://github.com/hmrc"),
-            "desc": local_metadata.get("desc"),
-            "labels": local_metadata.get("labels"),
-            "website_url": local_metadata.get("website_url"),
-            "issue_tracker_url": local_metadata.get("issue_tracker_url"),
-            "github_repo": local_metadata.get("github_repo"),
-            "github_release_notes_file": local_metadata.get(
-                "github_release_notes_file"
-            ),
-        }
-        if metadata["vcs_url"] is None:
-            metadata["vcs_url"] = "https://github.com/hmrc"
-        package_response = requests.post(
-            f"https://bintray.com/api/v1/packages/{self.organisation}/{repository}",
-            auth=self.api_creds,
-            json=metadata,
+        package_response = self.request(
+            "POST",
+            f"{self.api_url}/packages/{self.organisation}/{repository}",
+            json=new_package_metadata(local_metadata),
         )
         package_response.raise_for_status()
         return package_response.json()
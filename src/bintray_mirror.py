@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .bandwidth import bandwidth_from_environment
+from .bandwidth import ThrottledReader
+from .bintray_client import BintrayClient
+from .bintray_client import ChecksumMismatch
+from .bintray_client import HashingReader
+from .bintray_client import create_session
+from .bintray_client import crawl_metadata
+from .bintray_client import local_path
+from .bintray_client import map_with
+from .bintray_client import progress_bar
+from .bintray_client import repositories_from_environment
+from .bintray_client import retry_transfer
+from .bintray_client import BINTRAY_API_URL
+from .bintray_client import BINTRAY_DL_URL
+from .bintray_client import DEFAULT_MAX_WORKERS
+from .bintray_restore import DEFAULT_REPOSITORIES
+from .package_filter import package_filter_from_environment
+from .progress import progress
+from .tracing import tracer
+from .tracing import tracing_from_environment
+
+
+class PackageCreator:
+    # creates missing destination packages the first time one of their files
+    # is copied, so transfers never wait for a separate package creation pass
+    def __init__(self, bintray_client, missing_packages):
+        self.bintray_client = bintray_client
+        self.missing_packages = missing_packages
+        self.locks = {key: threading.Lock() for key in missing_packages}
+
+    def ensure_package(self, repository, package_name):
+        lock = self.locks.get((repository, package_name))
+        if lock is None:
+            return
+        with lock:
+            package = self.missing_packages.pop((repository, package_name), None)
+            if package is not None:
+                self.bintray_client.create_package(repository, package)
+
+    @property
+    def created_packages(self):
+        return len(self.locks) - len(self.missing_packages)
+
+
+class VersionPublisher:
+    # publishes each version once, after every one of its copies has been
+    # checked. a copy that failed leaves nothing unpublished behind, so the
+    # version's checked copies are published even if some of its files failed
+    def __init__(self, bintray_client, changed_files):
+        self.bintray_client = bintray_client
+        self.lock = threading.Lock()
+        self.remaining = Counter(version_key(file) for file in changed_files)
+        self.copied = Counter()
+        self.published_versions = 0
+
+    def finished(self, bintray_file, copied):
+        key = version_key(bintray_file)
+        with self.lock:
+            self.remaining[key] -= 1
+            self.copied[key] += copied
+            publish = self.remaining[key] == 0 and self.copied[key] > 0
+        if publish:
+            self.bintray_client.publish_version(*key)
+            with self.lock:
+                self.published_versions += 1
+
+
+def version_key(bintray_file):
+    return bintray_file["repo"], bintray_file["package"], bintray_file["version"]
+
+
+def files_to_mirror(source_files, destination_files):
+    destination_sha1s = {
+        local_path(bintray_file): bintray_file["sha1"]
+        for bintray_file in destination_files
+    }
+    return [
+        bintray_file
+        for bintray_file in source_files
+        if destination_sha1s.get(local_path(bintray_file)) != bintray_file["sha1"]
+    ]
+
+
+def mirror_and_publish(
+    source_client, destination_client, package_creator, version_publisher, bintray_file
+):
+    copied = False
+    try:
+        mirror_file(source_client, destination_client, package_creator, bintray_file)
+        copied = True
+    finally:
+        version_publisher.finished(bintray_file, copied)
+
+
+@retry_transfer
+def mirror_file(source_client, destination_client, package_creator, bintray_file):
+    # the copy is uploaded unpublished, to be published with its version once
+    # its sha1 is known to match. a corrupted copy is deleted and sent again
+    package_creator.ensure_package(bintray_file["repo"], bintray_file["package"])
+    url = source_client.download_url(bintray_file["repo"], bintray_file["path"])
+    with source_client.open_download(url) as response:
+        # the download is read in the small blocks the upload is written in,
+        # so only one block per transfer is ever held in memory
+        response.raw.decode_content = True
+        body = HashingReader(
+            ThrottledReader(
+                response.raw, bintray_file["size"], source_client.bandwidth.ingress
+            ),
+            bintray_file["size"],
+        )
+        destination_client.upload(local_path(bintray_file), body, publish=False)
+    if body.hexdigest() != bintray_file["sha1"]:
+        destination_client.delete_file(bintray_file["repo"], bintray_file["path"])
+        raise ChecksumMismatch(f"sha1 mismatch mirroring {local_path(bintray_file)}")
+
+
+def mirror(
+    username,
+    token,
+    source_organisation,
+    destination_organisation,
+    repositories=DEFAULT_REPOSITORIES,
+    max_workers=DEFAULT_MAX_WORKERS,
+    destination_username=None,
+    destination_token=None,
+    bandwidth=None,
+    api_url=BINTRAY_API_URL,
+    dl_url=BINTRAY_DL_URL,
+    package_filter=None,
+):
+    if source_organisation == destination_organisation:
+        raise Exception("cannot mirror an organisation onto itself")
+    session = create_session(max_workers)
+    source_client = BintrayClient(
+        source_organisation,
+        api_creds=requests.auth.HTTPBasicAuth(username, token),
+        session=session,
+        bandwidth=bandwidth,
+        api_url=api_url,
+        dl_url=dl_url,
+        package_filter=package_filter,
+    )
+    destination_client = BintrayClient(
+        destination_organisation,
+        api_creds=requests.auth.HTTPBasicAuth(
+            destination_username or username, destination_token or token
+        ),
+        session=session,
+        bandwidth=source_client.bandwidth,
+        api_url=api_url,
+        dl_url=dl_url,
+        package_filter=package_filter and package_filter.ignoring_dates(),
+    )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if repositories is None:
+            repositories = source_client.get_repository_names()
+        with tracer.span("crawl", "phase"):
+            metadata = crawl_metadata(
+                [(source_client, repository) for repository in repositories]
+                + [(destination_client, repository) for repository in repositories],
+                executor,
+            )
+        source_files, source_package_metadata = metadata[source_organisation]
+        destination_files, destination_package_metadata = metadata[
+            destination_organisation
+        ]
+
+        destination_packages = {
+            (package["repo"], package["name"])
+            for package in destination_package_metadata
+        }
+        package_creator = PackageCreator(
+            destination_client,
+            {
+                (package["repo"], package["name"]): package
+                for package in source_package_metadata
+                if (package["repo"], package["name"]) not in destination_packages
+            },
+        )
+        changed_files = files_to_mirror(source_files, destination_files)
+        version_publisher = VersionPublisher(destination_client, changed_files)
+        progress.log(
+            f"mirroring {len(changed_files)} files, skipping {len(source_files) - len(changed_files)} files that already exist"
+        )
+        with tracer.span("mirror", "phase"):
+            for _ in progress_bar("Mirroring files", len(changed_files), "out").iter(
+                map_with(
+                    executor,
+                    lambda bintray_file: mirror_and_publish(
+                        source_client,
+                        destination_client,
+                        package_creator,
+                        version_publisher,
+                        bintray_file,
+                    ),
+                    changed_files,
+                )
+            ):
+                pass
+
+    # packages without any files still need to exist in the destination
+    with tracer.span("create", "phase"):
+        for repository, package_name in list(package_creator.missing_packages):
+            package_creator.ensure_package(repository, package_name)
+    progress.log(f"created {package_creator.created_packages} packages")
+    progress.log("Done!")
+
+
+if __name__ == "__main__":
+    username = os.environ["BINTRAY_USERNAME"]
+    token = os.environ["BINTRAY_TOKEN"]
+    source_organisation = os.environ["BINTRAY_SOURCE_ORGANISATION"] # e.g. 'hmrc'
+    destination_organisation = os.environ["BINTRAY_DESTINATION_ORGANISATION"] # e.g. 'hmrc-digital'
+    tracing_from_environment()
+    mirror(
+        username,
+        token,
+        source_organisation,
+        destination_organisation,
+        repositories_from_environment(DEFAULT_REPOSITORIES),
+        int(os.environ.get("BINTRAY_MAX_WORKERS", DEFAULT_MAX_WORKERS)),
+        os.environ.get("BINTRAY_DESTINATION_USERNAME"),
+        os.environ.get("BINTRAY_DESTINATION_TOKEN"),
+        bandwidth_from_environment(),
+        package_filter=package_filter_from_environment(),
+    )
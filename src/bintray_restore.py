@@ -2,95 +2,359 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
+from src.backup_manifest import is_unchanged
+from src.backup_manifest import read_manifest
+from src.bandwidth import bandwidth_from_environment
+from src.bandwidth import BandwidthLimiter
 from src.bintray_client import BintrayClient
+from src.bintray_client import create_session
+from src.bintray_client import crawl_metadata
 from src.bintray_client import get_sha1_hash
-from src.bintray_client import PROGRESS_BAR_FORMAT
-from progress.bar import IncrementalBar
+from src.bintray_client import local_path
+from src.bintray_client import map_with
+from src.bintray_client import progress_bar
+from src.bintray_client import repositories_from_environment
+from src.bintray_client import BINTRAY_API_URL
+from src.bintray_client import BINTRAY_DL_URL
+from src.bintray_client import DEFAULT_MAX_WORKERS
+from src.package_filter import package_filter_from_environment
+from src.package_filter import select_local_files
+from src.progress import progress
+from src.tracing import tracer
+from src.tracing import tracing_from_environment
+from src.version_archive import upload_version_archive
+from src.version_archive import version_key
 
+DEFAULT_REPOSITORIES = ["releases", "sbt-plugin-releases"]
 
-def check_dirs_exist(repositories):
+
+def check_dirs_exist(repositories, root=Path(".")):
     for repository in repositories:
-        path = Path(f"{repository}")
+        path = root / f"{repository}"
         if not path.exists():
             raise Exception(f"{path} does not exist.")
 
 
-def get_local_files(repositories: list):
+def get_local_files(repositories: list, root=Path("."), manifest=None):
     package_metadata = []
     file_paths = []
 
-    print(f"Discovering local files")
+    # repositories recorded in the manifest are taken from it, any others
+    # are discovered by walking the directory tree
+    if manifest is not None:
+        files, manifest_package_metadata = manifest
+        recorded = {file["repo"] for file in files} | {
+            package["repo"] for package in manifest_package_metadata
+        }
+        # a file deleted since the backup is left out rather than failing its
+        # upload
+        file_paths.extend(
+            Path(local_path(file))
+            for file in files
+            if file["repo"] in repositories and (root / local_path(file)).is_file()
+        )
+        package_metadata.extend(
+            package
+            for package in manifest_package_metadata
+            if package["repo"] in repositories
+        )
+        repositories = [repo_name for repo_name in repositories if repo_name not in recorded]
+
+    progress.log(f"Discovering local files")
     for repo_name in repositories:
-        for path in Path(repo_name).glob("**/*"):
+        for path in (root / repo_name).glob("**/*"):
             if path.is_file():
                 if path.name == "package_metadata.json":
                     package_metadata.append(json.loads(path.read_text()))
                 else:
-                    file_paths.append(path)
+                    file_paths.append(path.relative_to(root))
 
     return file_paths, package_metadata
 
 
+def missing_packages(local_package_metadata, bintray_package_metadata):
+    # the same package name can be in several repositories
+    bintray_packages = {
+        (bintray_metadata["repo"], bintray_metadata["name"])
+        for bintray_metadata in bintray_package_metadata
+    }
+    return [
+        package
+        for package in local_package_metadata
+        if (package["repo"], package["name"]) not in bintray_packages
+    ]
+
+
 def create_new_packages(
-    bintray_client, local_package_metadata, bintray_package_metadata
+    bintray_client, local_package_metadata, bintray_package_metadata, executor=None
 ):
-    created_packages = 0
-    for package in IncrementalBar(
-        f"Creating packages", suffix=PROGRESS_BAR_FORMAT
-    ).iter(local_package_metadata):
-        package_name = package["name"]
-        if not any(
-            bintray_metadata["name"] == package_name
-            for bintray_metadata in bintray_package_metadata
-        ):
-            created_packages += 1
-            bintray_client.create_package(package["repo"], package)
-    print(
-        f"created {created_packages} packages, skipped {len(local_package_metadata) - created_packages} packages that already existed"
+    new_packages = missing_packages(local_package_metadata, bintray_package_metadata)
+    for _ in progress_bar("Creating packages", len(new_packages)).iter(
+        map_with(
+            executor,
+            lambda package: bintray_client.create_package(package["repo"], package),
+            new_packages,
+        )
+    ):
+        pass
+    progress.log(
+        f"created {len(new_packages)} packages, skipped {len(local_package_metadata) - len(new_packages)} packages that already existed"
     )
 
 
-def local_path(bintray_file):
-    return f"{bintray_file['repo']}/{bintray_file['package']}/{bintray_file['version']}/{bintray_file['path']}"
+def get_local_sha1s(root, manifest):
+    # only sha1s of files that are still as the backup wrote them are used,
+    # anything edited since is hashed again
+    return {
+        local_path(file): file["sha1"]
+        for file in (manifest or ([], []))[0]
+        if is_unchanged(file, root / local_path(file))
+    }
+
+
+def is_changed(path, bintray_sha1s, root=Path("."), local_sha1s=None):
+    with tracer.span("diff", path=str(path)):
+        bintray_sha1 = bintray_sha1s.get(str(path))
+        if bintray_sha1 is None:
+            return True
+        local_sha1 = (local_sha1s or {}).get(str(path)) or get_sha1_hash(root / path)
+        return local_sha1 != bintray_sha1
+
+
+def upload_if_changed(
+    bintray_client, path, bintray_sha1s, root=Path("."), local_sha1s=None
+):
+    if not is_changed(path, bintray_sha1s, root, local_sha1s):
+        return False
+    bintray_client.upload_file(path, local_root=root)
+    return True
 
 
-def upload_changed_files(bintray_client, local_files, bintray_files):
-    uploaded_files = 0
-    for path in IncrementalBar(f"Uploading files", suffix=PROGRESS_BAR_FORMAT).iter(
-        local_files
+def upload_changed_versions(bintray_client, changed_files, executor=None, root=Path(".")):
+    # versions with several changed files are uploaded as one exploded
+    # archive, returning the files that still need uploading one at a time
+    versions = {}
+    for path in changed_files:
+        versions.setdefault(version_key(path), []).append(path)
+    remaining_files = []
+    for paths in progress_bar("Uploading versions", len(versions), "out").iter(
+        map_with(
+            executor,
+            lambda paths: upload_version_archive(bintray_client, paths, root)
+            if len(paths) > 1
+            else paths,
+            versions.values(),
+        )
     ):
-        if not any(
-            str(path) == local_path(bintray_file)
-            and get_sha1_hash(path) == bintray_file["sha1"]
-            for bintray_file in bintray_files
+        remaining_files.extend(paths)
+    return remaining_files
+
+
+def upload_changed_files(
+    bintray_client,
+    local_files,
+    bintray_files,
+    executor=None,
+    root=Path("."),
+    local_sha1s=None,
+    bulk=False,
+):
+    bintray_sha1s = {
+        local_path(bintray_file): bintray_file["sha1"] for bintray_file in bintray_files
+    }
+    if bulk:
+        changed_files = [
+            path
+            for path, changed in zip(
+                local_files,
+                map_with(
+                    executor,
+                    lambda path: is_changed(path, bintray_sha1s, root, local_sha1s),
+                    local_files,
+                ),
+            )
+            if changed
+        ]
+        remaining_files = upload_changed_versions(
+            bintray_client, changed_files, executor, root
+        )
+        for _ in progress_bar("Uploading files", len(remaining_files), "out").iter(
+            map_with(
+                executor,
+                lambda path: bintray_client.upload_file(path, local_root=root),
+                remaining_files,
+            )
         ):
-            uploaded_files += 1
-            bintray_client.upload_file(path)
-    print(
+            pass
+        uploaded_files = len(changed_files)
+        progress.log(
+            f"uploaded {uploaded_files - len(remaining_files)} files in version archives and {len(remaining_files)} files one at a time"
+        )
+    else:
+        uploaded_files = 0
+        for uploaded in progress_bar("Uploading files", len(local_files), "out").iter(
+            map_with(
+                executor,
+                lambda path: upload_if_changed(
+                    bintray_client, path, bintray_sha1s, root, local_sha1s
+                ),
+                local_files,
+            )
+        ):
+            if uploaded:
+                uploaded_files += 1
+    progress.log(
         f"uploaded {uploaded_files} files, skipped {len(local_files) - uploaded_files} files that already existed"
     )
 
 
-def restore(username, token, organisation, repositories):
-    check_dirs_exist(repositories)
+def restore(
+    username,
+    token,
+    organisation,
+    repositories=DEFAULT_REPOSITORIES,
+    max_workers=DEFAULT_MAX_WORKERS,
+    max_requests_per_organisation=None,
+    bulk=False,
+    bandwidth=None,
+    api_url=BINTRAY_API_URL,
+    dl_url=BINTRAY_DL_URL,
+    package_filter=None,
+):
+    restore_organisations(
+        username,
+        token,
+        {organisation: Path(".")},
+        repositories,
+        max_workers,
+        max_requests_per_organisation,
+        bulk,
+        bandwidth,
+        api_url,
+        dl_url,
+        package_filter,
+    )
+
+
+def restore_organisations(
+    username,
+    token,
+    organisations,
+    repositories=DEFAULT_REPOSITORIES,
+    max_workers=DEFAULT_MAX_WORKERS,
+    max_requests_per_organisation=None,
+    bulk=False,
+    bandwidth=None,
+    api_url=BINTRAY_API_URL,
+    dl_url=BINTRAY_DL_URL,
+    package_filter=None,
+):
+    # bulk uploads each version with several changed files as a single
+    # archive that bintray explodes, falling back to uploading its files one
+    # at a time if the version's file listing does not match afterwards.
+    # organisations is either a list of names, each restored from a directory
+    # of the same name, or a dict of organisation name -> backup directory,
+    # as for backup_organisations.
+    # repositories=None restores every repository of the destination
+    # organisation that exists in the backup. package_filter limits the
+    # restore to some packages and versions, its date applying to the backup
+    if not isinstance(organisations, dict):
+        organisations = {organisation: Path(organisation) for organisation in organisations}
     bintray_api_creds = requests.auth.HTTPBasicAuth(username, token)
-    bintray_client = BintrayClient(organisation, api_creds=bintray_api_creds)
+    session = create_session(max_workers)
+    bandwidth = bandwidth if bandwidth is not None else BandwidthLimiter()
+    clients = {
+        Path(root): BintrayClient(
+            organisation,
+            api_creds=bintray_api_creds,
+            session=session,
+            max_in_flight=max_requests_per_organisation,
+            bandwidth=bandwidth,
+            api_url=api_url,
+            dl_url=dl_url,
+            package_filter=package_filter and package_filter.ignoring_dates(),
+        )
+        for organisation, root in organisations.items()
+    }
 
-    local_files, local_package_metadata = get_local_files(repositories)
-    bintray_files, bintray_package_metadata = bintray_client.get_metadata(repositories)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if repositories is None:
+            root_repositories = [
+                [name for name in names if (root / name).exists()]
+                for root, names in zip(
+                    clients,
+                    map_with(
+                        executor,
+                        lambda client: client.get_repository_names(),
+                        clients.values(),
+                    ),
+                )
+            ]
+        else:
+            root_repositories = [repositories] * len(clients)
+        for root, names in zip(clients, root_repositories):
+            check_dirs_exist(names, root)
 
-    create_new_packages(
-        bintray_client, local_package_metadata, bintray_package_metadata
-    )
-    upload_changed_files(bintray_client, local_files, bintray_files)
+        jobs = [
+            (client, repository)
+            for client, names in zip(clients.values(), root_repositories)
+            for repository in names
+        ]
+        with tracer.span("crawl", "phase"):
+            bintray_metadata = crawl_metadata(jobs, executor)
+
+        for (root, bintray_client), names in zip(clients.items(), root_repositories):
+            # a backup's manifest lists its files and their sha1s, so neither
+            # the directory walk nor hashing every local file is needed
+            with tracer.phase("scan", root=str(root)):
+                manifest = read_manifest(root)
+                local_files, local_package_metadata = get_local_files(
+                    names, root, manifest
+                )
+                if package_filter is not None:
+                    local_files, local_package_metadata = select_local_files(
+                        local_files, local_package_metadata, package_filter
+                    )
+                local_sha1s = get_local_sha1s(root, manifest)
+            bintray_files, bintray_package_metadata = bintray_metadata.get(
+                bintray_client.organisation, ([], [])
+            )
+            with tracer.span("create", "phase", root=str(root)):
+                create_new_packages(
+                    bintray_client,
+                    local_package_metadata,
+                    bintray_package_metadata,
+                    executor,
+                )
+            with tracer.span("upload", "phase", root=str(root)):
+                upload_changed_files(
+                    bintray_client,
+                    local_files,
+                    bintray_files,
+                    executor,
+                    root,
+                    local_sha1s,
+                    bulk,
+                )
 
 
 if __name__ == "__main__":
     username = os.environ["BINTRAY_USERNAME"]
     token = os.environ["BINTRAY_TOKEN"]
-    organisation = os.environ["BINTRAY_ORGANISATION"] # e.g. 'hmrc' or 'hmrc-digital'
-    repositories = ["releases", "sbt-plugin-releases"]
-    restore(username, token, organisation, repositories)
+    organisations = os.environ["BINTRAY_ORGANISATION"].split(",") # e.g. 'hmrc' or 'hmrc-digital,hmrc'
+    repositories = repositories_from_environment(DEFAULT_REPOSITORIES)
+    max_workers = int(os.environ.get("BINTRAY_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    max_requests = os.environ.get("BINTRAY_MAX_REQUESTS_PER_ORGANISATION")
+    max_requests = int(max_requests) if max_requests else None
+    bulk = os.environ.get("BINTRAY_BULK_UPLOAD") == "1"
+    bandwidth = bandwidth_from_environment()
+    package_filter = package_filter_from_environment()
+    tracing_from_environment()
+    if len(organisations) == 1:
+        restore(username, token, organisations[0], repositories, max_workers, max_requests, bulk, bandwidth, package_filter=package_filter)
+    else:
+        restore_organisations(username, token, organisations, repositories, max_workers, max_requests, bulk, bandwidth, package_filter=package_filter)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import functools
+import json
+import os
+import select
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from .backup_manifest import is_unchanged
+from .backup_manifest import read_manifest
+from .bandwidth import bandwidth_from_environment
+from .bintray_client import BintrayClient
+from .bintray_client import create_session
+from .bintray_client import get_sha1_hash
+from .bintray_client import local_path
+from .bintray_client import repositories_from_environment
+from .bintray_client import BINTRAY_API_URL
+from .bintray_client import BINTRAY_DL_URL
+from .bintray_client import DEFAULT_MAX_WORKERS
+from .bintray_restore import check_dirs_exist
+from .bintray_restore import DEFAULT_REPOSITORIES
+from .progress import progress
+from .tracing import tracing_from_environment
+
+# keeps a destination organisation in step with a backup tree that is still
+# being written to. the remote listing is crawled once, after that inotify
+# says which files changed and the in-memory index of remote sha1s is kept
+# up to date as uploads succeed, so nothing is walked or crawled again
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+PACKAGE_METADATA = "package_metadata.json"
+DEFAULT_METADATA_WAIT = 60.0
+MAX_RETRY_DELAY = 300.0
+
+
+class Inotify:
+    # the few inotify calls needed, through libc so no extra dependency is
+    # needed. linux only
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"cannot watch {path}")
+        self.paths[wd] = Path(path)
+
+    def read_events(self, timeout):
+        # yields (path, mask) for each event, waiting at most timeout seconds
+        # for the first one. path is None when the event queue overflowed
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                yield None, mask
+            elif mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                yield self.paths[wd] / os.fsdecode(name), mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RemoteIndex:
+    # what the destination is known to hold: a sha1 for every file and the
+    # set of packages. packages are created once however many files of a
+    # new package arrive at the same time
+    def __init__(self, bintray_files, bintray_package_metadata):
+        self.lock = threading.Lock()
+        self.sha1s = {
+            local_path(bintray_file): bintray_file["sha1"] for bintray_file in bintray_files
+        }
+        self.packages = {
+            (package["repo"], package["name"]) for package in bintray_package_metadata
+        }
+        self.package_locks = {}
+
+    def sha1(self, path):
+        with self.lock:
+            return self.sha1s.get(path)
+
+    def has_package(self, repository, package_name):
+        with self.lock:
+            return (repository, package_name) in self.packages
+
+    def uploaded(self, path, sha1):
+        with self.lock:
+            self.sha1s[path] = sha1
+
+    def ensure_package(self, bintray_client, root, repository, package_name):
+        with self.lock:
+            if (repository, package_name) in self.packages:
+                return False
+            lock = self.package_locks.setdefault(
+                (repository, package_name), threading.Lock()
+            )
+        with lock:
+            with self.lock:
+                if (repository, package_name) in self.packages:
+                    return False
+            metadata_path = Path(root, repository, package_name, PACKAGE_METADATA)
+            if metadata_path.exists():
+                metadata = json.loads(metadata_path.read_text())
+            else:
+                metadata = {"name": package_name}
+            try:
+                bintray_client.create_package(repository, metadata)
+            except requests.HTTPError as e:
+                # created since the crawl by someone else
+                if e.response is None or e.response.status_code != 409:
+                    raise
+                return False
+            with self.lock:
+                self.packages.add((repository, package_name))
+            return True
+
+
+class RestoreWatcher:
+    def __init__(
+        self,
+        bintray_client,
+        repositories,
+        root=Path("."),
+        settle=1.0,
+        metadata_wait=DEFAULT_METADATA_WAIT,
+    ):
+        # settle is how long a file must have been quiet before it is
+        # uploaded, so a file that is written several times goes up once.
+        # metadata_wait is how long a file of a new package waits for the
+        # package's metadata before the package is created without it
+        self.bintray_client = bintray_client
+        self.repositories = repositories
+        self.root = Path(root)
+        self.settle = settle
+        self.metadata_wait = metadata_wait
+        self.inotify = Inotify()
+        self.index = None
+        self.local_records = {}
+        self.pending = {}
+        # files put back by workers, with how long each should wait before it
+        # is tried again, and when each was first put back to wait for its
+        # package's metadata
+        self.deferred = []
+        self.waiting_since = {}
+        # how many times in a row each file has failed to upload
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.uploaded_files = 0
+        self.created_packages = 0
+
+    def watch_tree(self, directory):
+        # new directories are watched as they appear. anything written into
+        # one before its watch was added is picked up by the walk
+        for dirpath, _, filenames in os.walk(directory):
+            self.inotify.add_watch(dirpath)
+            for filename in filenames:
+                self.queue(Path(dirpath) / filename)
+
+    def queue(self, path):
+        self.pending[path] = time.monotonic()
+
+    def start(self, executor=None, catch_up=True):
+        # watches are added before the crawl so nothing written during it is
+        # missed. catch_up also restores whatever is already in the tree
+        for repository in self.repositories:
+            self.watch_tree(self.root / repository)
+        if not catch_up:
+            self.pending.clear()
+        # files the backup recorded and that are untouched since are not hashed
+        manifest = read_manifest(self.root)
+        self.local_records = {
+            local_path(record): record for record in (manifest or ([], []))[0]
+        }
+        self.index = RemoteIndex(
+            *self.bintray_client.get_metadata(self.repositories, executor)
+        )
+
+    def run(self, executor, stop=None):
+        stop = stop if stop is not None else threading.Event()
+        while not stop.is_set():
+            for path, mask in self.inotify.read_events(min(self.settle, 0.5)):
+                if path is None:
+                    progress.log("inotify queue overflowed, rescanning")
+                    for repository in self.repositories:
+                        self.watch_tree(self.root / repository)
+                elif mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.watch_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.queue(path)
+            self.flush(executor)
+
+    def flush(self, executor):
+        with self.lock:
+            deferred, self.deferred = self.deferred, []
+        for path, delay in deferred:
+            self.pending.setdefault(path, time.monotonic() + delay)
+        settled_before = time.monotonic() - self.settle
+        settled = [path for path, seen in self.pending.items() if seen <= settled_before]
+        for path in settled:
+            del self.pending[path]
+            executor.submit(self.restore_file, path).add_done_callback(
+                functools.partial(self.restored, path)
+            )
+
+    def restored(self, path, future):
+        # a failed file is reported and put back in the queue, it waits twice
+        # as long after each failure in a row. writing it again retries it
+        # at once
+        error = future.exception()
+        with self.lock:
+            if error is None:
+                self.failures.pop(path, None)
+                return
+            failures = self.failures[path] = self.failures.get(path, 0) + 1
+            self.deferred.append(
+                (path, min(self.settle * 2 ** failures, MAX_RETRY_DELAY))
+            )
+        progress.log(f"upload of {path} failed, attempt {failures}: {error}")
+
+    def restore_file(self, path):
+        relative_path = path.relative_to(self.root)
+        parts = relative_path.parts
+        if path.name == PACKAGE_METADATA and len(parts) == 3:
+            self.ensure_package(parts[0], parts[1])
+            return
+        # files live at repository/package/version/path
+        if len(parts) < 4 or not path.is_file():
+            return
+        # checked before the file is hashed, a file waiting for its metadata
+        # comes back every settle interval
+        if self.waiting_for_metadata(path, parts[0], parts[1]):
+            return
+        record = self.local_records.get(str(relative_path))
+        if record is not None and is_unchanged(record, path):
+            sha1 = record["sha1"]
+        else:
+            sha1 = get_sha1_hash(path)
+        if self.index.sha1(str(relative_path)) == sha1:
+            return
+        self.ensure_package(parts[0], parts[1])
+        # the file may have changed again since it was hashed, the index
+        # records what was actually sent
+        sha1 = self.bintray_client.upload_file(relative_path, local_root=self.root)
+        self.index.uploaded(str(relative_path), sha1)
+        with self.lock:
+            self.uploaded_files += 1
+        progress.log(f"uploaded {relative_path}")
+
+    def waiting_for_metadata(self, path, repository, package_name):
+        # a file can land before its package's metadata, the file is put back
+        # in the queue rather than create the package without its metadata
+        ready = self.index.has_package(repository, package_name) or Path(
+            self.root, repository, package_name, PACKAGE_METADATA
+        ).exists()
+        with self.lock:
+            since = self.waiting_since.pop(path, time.monotonic())
+            if ready or time.monotonic() - since >= self.metadata_wait:
+                return False
+            self.waiting_since[path] = since
+            self.deferred.append((path, 0))
+            return True
+
+    def ensure_package(self, repository, package_name):
+        if self.index.ensure_package(
+            self.bintray_client, self.root, repository, package_name
+        ):
+            with self.lock:
+                self.created_packages += 1
+
+    def close(self):
+        self.inotify.close()
+
+
+def watch(
+    username,
+    token,
+    organisation,
+    repositories=DEFAULT_REPOSITORIES,
+    root=Path("."),
+    max_workers=DEFAULT_MAX_WORKERS,
+    settle=1.0,
+    metadata_wait=DEFAULT_METADATA_WAIT,
+    catch_up=True,
+    bandwidth=None,
+    api_url=BINTRAY_API_URL,
+    dl_url=BINTRAY_DL_URL,
+    stop=None,
+):
+    # runs until stop (a threading.Event) is set, or forever
+    # repositories=None watches every repository of the organisation that
+    # exists in the backup
+    root = Path(root)
+    bintray_client = BintrayClient(
+        organisation,
+        api_creds=requests.auth.HTTPBasicAuth(username, token),
+        session=create_session(max_workers),
+        bandwidth=bandwidth,
+        api_url=api_url,
+        dl_url=dl_url,
+    )
+    if repositories is None:
+        repositories = [
+            name
+            for name in bintray_client.get_repository_names()
+            if (root / name).exists()
+        ]
+    check_dirs_exist(repositories, root)
+    watcher = RestoreWatcher(bintray_client, repositories, root, settle, metadata_wait)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            watcher.start(executor, catch_up)
+            progress.log(f"watching {', '.join(repositories)} in {root.resolve()}")
+            watcher.run(executor, stop)
+    finally:
+        watcher.close()
+    progress.log(
+        f"uploaded {watcher.uploaded_files} files, created {watcher.created_packages} packages"
+    )
+    return watcher
+
+
+if __name__ == "__main__":
+    username = os.environ["BINTRAY_USERNAME"]
+    token = os.environ["BINTRAY_TOKEN"]
+    organisation = os.environ["BINTRAY_ORGANISATION"] # e.g. 'hmrc-digital'
+    repositories = repositories_from_environment(DEFAULT_REPOSITORIES)
+    max_workers = int(os.environ.get("BINTRAY_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    tracing_from_environment()
+    try:
+        watch(username, token, organisation, repositories, Path("."), max_workers, bandwidth=bandwidth_from_environment())
+    except KeyboardInterrupt:
+        pass
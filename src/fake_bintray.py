@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+# a local stand-in for the parts of the Bintray API that BintrayClient uses,
+# for exercising backup and restore under real concurrency, latency, errors
+# and throttling. package files are generated from their path, so a large
+# corpus costs almost no memory, and uploads only keep their size and sha1
+
+
+def file_content(path, size):
+    seed = path.encode()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class FakeBintray:
+    def __init__(
+        self,
+        organisation="hmrc",
+        repositories=1,
+        packages=10,
+        versions=3,
+        files_per_version=4,
+        file_size=1024,
+        page_size=50,
+        latency=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        seed=0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        # handler names in the order their requests arrived
+        self.history = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # organisation -> repository -> package name -> package
+        self.organisations = {}
+        # (organisation, repository, path) -> file, for downloads
+        self.paths = {}
+        self.generate_corpus(
+            organisation, repositories, packages, versions, files_per_version, file_size
+        )
+
+    def generate_corpus(
+        self, organisation, repositories, packages, versions, files_per_version, file_size
+    ):
+        for repository_index in range(repositories):
+            repository = f"repository-{repository_index}"
+            for package_index in range(packages):
+                name = f"package-{package_index}"
+                self.add_package(organisation, repository, {"name": name})
+                for version_index in range(versions):
+                    version = f"1.{version_index}.0"
+                    for file_index in range(files_per_version):
+                        path = f"uk/gov/hmrc/{name}/{version}/{name}-{version}-{file_index}.jar"
+                        content = file_content(path, file_size)
+                        self.add_file(
+                            organisation,
+                            repository,
+                            name,
+                            version,
+                            path,
+                            len(content),
+                            hashlib.sha1(content).hexdigest(),
+                            generated=True,
+                        )
+
+    def repository(self, organisation, repository):
+        return self.organisations.setdefault(organisation, {}).setdefault(
+            repository, {}
+        )
+
+    def add_package(self, organisation, repository, metadata):
+        packages = self.repository(organisation, repository)
+        if metadata["name"] not in packages:
+            packages[metadata["name"]] = {
+                "information": {
+                    **metadata,
+                    "repo": repository,
+                    "owner": organisation,
+                    "versions": [],
+                    "latest_version": None,
+                    "updated": "2020-12-01T00:00:00.000Z",
+                },
+                "files": {},
+            }
+        return packages[metadata["name"]]
+
+    def add_file(
+        self,
+        organisation,
+        repository,
+        package_name,
+        version,
+        path,
+        size,
+        sha1,
+        generated=False,
+        published=True,
+    ):
+        package = self.add_package(organisation, repository, {"name": package_name})
+        information = package["information"]
+        if version not in information["versions"]:
+            information["versions"].insert(0, version)
+            information["latest_version"] = version
+        now = time.time()
+        information["updated"] = time.strftime(
+            f"%Y-%m-%dT%H:%M:%S.{int(now * 1000) % 1000:03d}Z", time.gmtime(now)
+        )
+        package["files"][path] = self.paths[(organisation, repository, path)] = {
+            "name": path.rsplit("/", 1)[-1],
+            "path": path,
+            "package": package_name,
+            "version": version,
+            "repo": repository,
+            "owner": organisation,
+            "created": information["updated"],
+            "size": size,
+            "sha1": sha1,
+            "generated": generated,
+            "published": published,
+        }
+
+    def remove_file(self, organisation, repository, path):
+        file = self.paths.pop((organisation, repository, path), None)
+        if file is not None:
+            del self.repository(organisation, repository)[file["package"]]["files"][path]
+        return file
+
+    def listing(self, files):
+        return [
+            {
+                key: value
+                for key, value in file.items()
+                if key not in ("generated", "published")
+            }
+            for file in files
+        ]
+
+    def serve(self, host="127.0.0.1", port=0):
+        # starts serving on a background thread, returning the server
+        fake = self
+
+        class Handler(FakeBintrayHandler):
+            bintray = fake
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def server_urls(server):
+    host, port = server.server_address[:2]
+    return {
+        "api_url": f"http://{host}:{port}/api/v1",
+        "dl_url": f"http://{host}:{port}/dl",
+    }
+
+
+class FakeBintrayHandler(BaseHTTPRequestHandler):
+    bintray = None
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, with Nagle's algorithm
+    # each response would stall on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    routes = [
+        ("GET", r"/api/v1/repos/(?P<organisation>[^/]+)/?", "get_repositories"),
+        (
+            "GET",
+            r"/api/v1/repos/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/packages",
+            "get_packages",
+        ),
+        (
+            "GET",
+            r"/api/v1/packages/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/(?P<package>[^/]+)",
+            "get_package",
+        ),
+        (
+            "GET",
+            r"/api/v1/packages/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/(?P<package>[^/]+)/files",
+            "get_package_files",
+        ),
+        (
+            "GET",
+            r"/api/v1/packages/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/(?P<package>[^/]+)/versions/(?P<version>[^/]+)/files",
+            "get_version_files",
+        ),
+        (
+            "POST",
+            r"/api/v1/packages/(?P<organisation>[^/]+)/(?P<repository>[^/]+)",
+            "create_package",
+        ),
+        (
+            "PUT",
+            r"/api/v1/content/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/(?P<package>[^/]+)/(?P<version>[^/]+)/(?P<path>.+)",
+            "upload",
+        ),
+        (
+            "POST",
+            r"/api/v1/content/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/(?P<package>[^/]+)/(?P<version>[^/]+)/publish",
+            "publish",
+        ),
+        (
+            "DELETE",
+            r"/api/v1/content/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/(?P<path>.+)",
+            "delete_file",
+        ),
+        (
+            "GET",
+            r"/dl/(?P<organisation>[^/]+)/(?P<repository>[^/]+)/(?P<path>.+)",
+            "download",
+        ),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        body = self.read_body()
+        bintray = self.bintray
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(404, {"message": "not found"})
+
+        with bintray.lock:
+            bintray.requests[handler] += 1
+            bintray.history.append(handler)
+            bintray.bytes_received += len(body)
+            roll = bintray.random.random()
+        if bintray.latency:
+            time.sleep(bintray.latency)
+        if roll < bintray.throttle_rate + bintray.error_rate:
+            throttled = roll < bintray.throttle_rate
+            with bintray.lock:
+                bintray.requests["throttled" if throttled else "errors"] += 1
+            if throttled:
+                return self.respond(
+                    429, {"message": "throttled"}, {"Retry-After": "0.1"}
+                )
+            return self.respond(500, {"message": "injected error"})
+        # handlers only touch the corpus under the lock, responses are written
+        # outside it so slow clients do not hold up everyone else
+        with bintray.lock:
+            response = getattr(self, handler)(
+                parse_qs(url.query), body, **match.groupdict()
+            )
+        return self.respond(*response)
+
+    def read_body(self):
+        if "Content-Length" in self.headers:
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body.extend(self.rfile.read(size))
+                self.rfile.readline()
+        return b""
+
+    def respond(self, status, payload, headers=None):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header(
+            "Content-Type",
+            "application/octet-stream" if isinstance(payload, bytes) else "application/json",
+        )
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.bintray.lock:
+            self.bintray.bytes_sent += len(body)
+
+    def get_repositories(self, query, body, organisation):
+        return (
+            200,
+            [
+                {"name": name, "owner": organisation}
+                for name in self.bintray.organisations.get(organisation, {})
+            ],
+        )
+
+    def get_packages(self, query, body, organisation, repository):
+        names = sorted(self.bintray.repository(organisation, repository))
+        start_pos = int(query.get("start_pos", ["0"])[0])
+        page = names[start_pos : start_pos + self.bintray.page_size]
+        headers = {}
+        if page:
+            headers = {
+                "X-RangeLimit-Total": str(len(names)),
+                "X-RangeLimit-EndPos": str(start_pos + len(page) - 1),
+            }
+        return (
+            200, [{"name": name, "linked": False} for name in page], headers
+        )
+
+    def package(self, organisation, repository, package):
+        return self.bintray.repository(organisation, repository).get(package)
+
+    def get_package(self, query, body, organisation, repository, package):
+        found = self.package(organisation, repository, package)
+        if found is None:
+            return (404, {"message": "package not found"})
+        return (200, found["information"])
+
+    def get_package_files(self, query, body, organisation, repository, package):
+        found = self.package(organisation, repository, package)
+        if found is None:
+            return (404, {"message": "package not found"})
+        return (200, self.bintray.listing(found["files"].values()))
+
+    def get_version_files(self, query, body, organisation, repository, package, version):
+        found = self.package(organisation, repository, package)
+        if found is None:
+            return (404, {"message": "package not found"})
+        return (
+            200,
+            self.bintray.listing(
+                file for file in found["files"].values() if file["version"] == version
+            ),
+        )
+
+    def create_package(self, query, body, organisation, repository):
+        metadata = json.loads(body)
+        if metadata["name"] in self.bintray.repository(organisation, repository):
+            return (409, {"message": "package already exists"})
+        self.bintray.add_package(organisation, repository, metadata)
+        return (201, metadata)
+
+    def upload(self, query, body, organisation, repository, package, version, path):
+        if self.package(organisation, repository, package) is None:
+            return (404, {"message": "package not found"})
+        if query.get("explode") == ["1"]:
+            with zipfile.ZipFile(io.BytesIO(body)) as archive:
+                entries = [(name, archive.read(name)) for name in archive.namelist()]
+        else:
+            entries = [(path, body)]
+        for entry_path, content in entries:
+            self.bintray.add_file(
+                organisation,
+                repository,
+                package,
+                version,
+                entry_path,
+                len(content),
+                hashlib.sha1(content).hexdigest(),
+                published=query.get("publish") == ["1"],
+            )
+        return (201, {"message": "success"})
+
+    def publish(self, query, body, organisation, repository, package, version):
+        found = self.package(organisation, repository, package)
+        if found is None:
+            return (404, {"message": "package not found"})
+        unpublished = [
+            file
+            for file in found["files"].values()
+            if file["version"] == version and not file["published"]
+        ]
+        for file in unpublished:
+            file["published"] = True
+        return (200, {"files": len(unpublished)})
+
+    def delete_file(self, query, body, organisation, repository, path):
+        if self.bintray.remove_file(organisation, repository, path) is None:
+            return (404, {"message": "file not found"})
+        return (200, {"message": "success"})
+
+    def download(self, query, body, organisation, repository, path):
+        file = self.bintray.paths.get((organisation, repository, path))
+        if file is None or not file["generated"]:
+            return (404, {"message": "file not found"})
+        return (200, file_content(path, file["size"]))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import tempfile
+import time
+
+from .bandwidth import BandwidthLimiter
+from .bintray_backup import backup_organisations
+from .bintray_client import DEFAULT_MAX_WORKERS
+from .bintray_restore import restore_organisations
+from .fake_bintray import FakeBintray
+from .fake_bintray import server_urls
+
+SOURCE = "hmrc"
+DESTINATION = "hmrc-digital"
+
+
+def timed(function, *args, **kwargs):
+    started = time.monotonic()
+    function(*args, **kwargs)
+    return time.monotonic() - started
+
+
+def run(
+    repositories=1,
+    packages=10,
+    versions=3,
+    files_per_version=4,
+    file_size=1024,
+    latency=0.0,
+    error_rate=0.0,
+    throttle_rate=0.0,
+    max_workers=DEFAULT_MAX_WORKERS,
+    bulk=False,
+    download_rate=None,
+    upload_rate=None,
+):
+    # backs up the whole fake corpus into a temporary directory and restores
+    # it into a second organisation, returning what was moved and how fast
+    bintray = FakeBintray(
+        SOURCE,
+        repositories,
+        packages,
+        versions,
+        files_per_version,
+        file_size,
+        latency=latency,
+        error_rate=error_rate,
+        throttle_rate=throttle_rate,
+    )
+    server = bintray.serve()
+    repository_names = list(bintray.organisations[SOURCE])
+    options = {
+        "max_workers": max_workers,
+        "bandwidth": BandwidthLimiter(download_rate, upload_rate),
+        **server_urls(server),
+    }
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            backup_seconds = timed(
+                backup_organisations,
+                "user",
+                "token",
+                {SOURCE: root},
+                repository_names,
+                **options,
+            )
+            restore_seconds = timed(
+                restore_organisations,
+                "user",
+                "token",
+                {DESTINATION: root},
+                repository_names,
+                bulk=bulk,
+                **options,
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    files = repositories * packages * versions * files_per_version
+    return {
+        "files": files,
+        "bytes": files * file_size,
+        "backup_seconds": backup_seconds,
+        "restore_seconds": restore_seconds,
+        "requests": dict(bintray.requests),
+        "bytes_sent": bintray.bytes_sent,
+        "bytes_received": bintray.bytes_received,
+    }
+
+
+def print_report(report):
+    print()
+    print(f"{report['files']} files, {report['bytes'] / 1e6:.1f} MB")
+    for phase in ["backup", "restore"]:
+        seconds = report[f"{phase}_seconds"]
+        print(
+            f"{phase:8} {seconds:8.2f}s {report['files'] / seconds:10.1f} files/s {report['bytes'] / 1e6 / seconds:8.2f} MB/s"
+        )
+    print(
+        f"server sent {report['bytes_sent'] / 1e6:.1f} MB, received {report['bytes_received'] / 1e6:.1f} MB"
+    )
+    for name, count in sorted(report["requests"].items()):
+        print(f"  {name:20} {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run backup and restore against a local fake Bintray"
+    )
+    parser.add_argument("--repositories", type=int, default=1)
+    parser.add_argument("--packages", type=int, default=10)
+    parser.add_argument("--versions", type=int, default=3)
+    parser.add_argument("--files-per-version", type=int, default=4)
+    parser.add_argument("--file-size", type=int, default=1024, help="bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500s")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of 429s")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--bulk", action="store_true", help="restore versions as archives")
+    parser.add_argument("--download-rate", type=int, help="bytes per second")
+    parser.add_argument("--upload-rate", type=int, help="bytes per second")
+    print_report(run(**vars(parser.parse_args())))
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import os
+import re
+from pathlib import PurePath
+
+VERSION_OPERATORS = {
+    ">=": lambda version, bound: version >= bound,
+    "<=": lambda version, bound: version <= bound,
+    "==": lambda version, bound: version == bound,
+    "!=": lambda version, bound: version != bound,
+    ">": lambda version, bound: version > bound,
+    "<": lambda version, bound: version < bound,
+}
+
+
+def version_key(version):
+    # "1.10.0" sorts after "1.9.0", non numeric parts sort before numbers
+    return tuple(
+        (int(part), "") if part.isdigit() else (-1, part)
+        for part in re.split(r"[.\-+]", version)
+    )
+
+
+def parse_versions(versions):
+    # ">=1.2.0,<2.0.0" or a glob such as "1.2.*", every clause must match
+    clauses = []
+    for clause in (versions or "").split(","):
+        clause = clause.strip()
+        if not clause:
+            continue
+        operator = next(
+            (operator for operator in VERSION_OPERATORS if clause.startswith(operator)),
+            None,
+        )
+        if operator is None:
+            clauses.append(lambda version, glob=clause: fnmatch.fnmatchcase(version, glob))
+        else:
+            bound = version_key(clause[len(operator) :].strip())
+            compare = VERSION_OPERATORS[operator]
+            clauses.append(
+                lambda version, compare=compare, bound=bound: compare(
+                    version_key(version), bound
+                )
+            )
+    return clauses
+
+
+class PackageFilter:
+    # selects the packages and versions a run covers. include and exclude are
+    # globs on the package name, versions is a range such as ">=1.2.0,<2.0.0"
+    # and updated_since an ISO 8601 date the package's last update must not
+    # be before. the crawl checks names before any package is requested and
+    # versions before any file listing is, so filtered out packages cost
+    # nothing beyond the package name listing
+    def __init__(self, include=None, exclude=None, versions=None, updated_since=None):
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.versions = versions
+        self.version_clauses = parse_versions(versions)
+        self.updated_since = updated_since
+
+    @property
+    def selects_everything(self):
+        return not (
+            self.include or self.exclude or self.version_clauses or self.updated_since
+        )
+
+    @property
+    def filters_versions(self):
+        return bool(self.version_clauses)
+
+    def includes_package(self, name):
+        if self.include and not any(
+            fnmatch.fnmatchcase(name, glob) for glob in self.include
+        ):
+            return False
+        return not any(fnmatch.fnmatchcase(name, glob) for glob in self.exclude)
+
+    def includes_version(self, version):
+        return all(clause(version) for clause in self.version_clauses)
+
+    def includes_updated(self, package_information):
+        # bintray dates are ISO 8601 in UTC, so they compare as strings
+        updated = package_information.get("updated")
+        return not self.updated_since or updated is None or updated >= self.updated_since
+
+    def includes_path(self, path):
+        # a local path is repository/package/version/..., anything shallower
+        # such as releases/.DS_Store is not a file of any version
+        parts = PurePath(path).parts
+        return (
+            len(parts) >= 4
+            and self.includes_package(parts[1])
+            and self.includes_version(parts[2])
+        )
+
+    def ignoring_dates(self):
+        # the destination of a restore or mirror is filtered by name and
+        # version only, its packages being older than the source's does not
+        # mean they are missing
+        return PackageFilter(self.include, self.exclude, self.versions)
+
+
+def select_local_files(local_files, local_package_metadata, package_filter):
+    # applies a filter to a backup, dates come from its package metadata
+    package_metadata = [
+        package
+        for package in local_package_metadata
+        if package_filter.includes_package(package["name"])
+        and package_filter.includes_updated(package)
+    ]
+    selected_packages = {(package["repo"], package["name"]) for package in package_metadata}
+    known_packages = {
+        (package["repo"], package["name"]) for package in local_package_metadata
+    }
+    files = [
+        path
+        for path in local_files
+        if package_filter.includes_path(path)
+        and (
+            PurePath(path).parts[:2] in selected_packages
+            or PurePath(path).parts[:2] not in known_packages
+        )
+    ]
+    return files, package_metadata
+
+
+def package_filter_from_environment():
+    # None when no filter is set, so an unfiltered run is left as it was
+    def globs(name):
+        value = os.environ.get(name)
+        return [glob.strip() for glob in value.split(",")] if value else []
+
+    package_filter = PackageFilter(
+        globs("BINTRAY_INCLUDE_PACKAGES"),
+        globs("BINTRAY_EXCLUDE_PACKAGES"),
+        os.environ.get("BINTRAY_VERSIONS"),
+        os.environ.get("BINTRAY_UPDATED_SINCE"),
+    )
+    return None if package_filter.selects_everything else package_filter
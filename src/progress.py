@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+# progress for runs spread across worker threads. workers only bump counters
+# and queue messages under a lock, a single renderer thread draws them at a
+# fixed rate: one status line redrawn in place on a terminal, or a JSON line
+# per phase for logs and CI. BINTRAY_PROGRESS=tty, json or off overrides the
+# choice made from whether stderr is a terminal
+
+RENDER_INTERVAL = 0.5
+DIRECTIONS = ("in", "out")
+
+
+class Phase:
+    # counts the items of one step of a run, and the bytes moved in one
+    # direction while it is going when transfer is "in" or "out"
+    def __init__(self, bus, name, total=None, transfer=None):
+        self.bus = bus
+        self.name = name
+        self.total = total
+        self.transfer = transfer
+        self.done = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.bytes_before = bus.bytes[transfer] if transfer else 0
+
+    def next(self, count=1):
+        with self.bus.lock:
+            self.done += count
+
+    def iter(self, items):
+        with self:
+            for item in items:
+                yield item
+                self.next()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.bus.finish(self)
+
+    def snapshot(self, now):
+        # called with the bus lock held
+        elapsed = max((self.finished or now) - self.started, 1e-9)
+        transferred = self.bus.bytes[self.transfer] - self.bytes_before if self.transfer else 0
+        return {
+            "phase": self.name,
+            "done": self.done,
+            "total": self.total,
+            "bytes": transferred,
+            "elapsed": round(elapsed, 3),
+            "rate": round(self.done / elapsed, 2),
+            "bytes_rate": round(transferred / elapsed),
+            "finished": self.finished is not None,
+        }
+
+
+class ProgressBus:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = []
+        self.messages = []
+        self.bytes = dict.fromkeys(DIRECTIONS, 0)
+        self.stream = None
+        self.mode = None
+        self.interval = RENDER_INTERVAL
+        self.renderer = None
+        # only one thread draws at a time, the renderer or a finishing phase
+        self.drawing = threading.Lock()
+
+    def configure(self, mode=None, stream=None, interval=RENDER_INTERVAL):
+        # mode is "tty", "json" or "off", None picks tty or json from the
+        # stream, which defaults to whatever sys.stderr is when drawing
+        self.mode = mode
+        self.stream = stream
+        self.interval = interval
+
+    def output(self):
+        stream = self.stream if self.stream is not None else sys.stderr
+        mode = self.mode or os.environ.get("BINTRAY_PROGRESS")
+        if not mode:
+            isatty = getattr(stream, "isatty", None)
+            mode = "tty" if isatty is not None and isatty() else "json"
+        return mode, stream
+
+    def phase(self, name, total=None, transfer=None):
+        with self.lock:
+            phase = Phase(self, name, total, transfer)
+            self.active.append(phase)
+        self.start_renderer()
+        return phase
+
+    def start_renderer(self):
+        with self.lock:
+            if self.renderer is not None:
+                return
+            self.renderer = threading.Thread(target=self.render_forever, daemon=True)
+        self.renderer.start()
+        # whatever was posted since the last refresh is drawn on the way out
+        atexit.register(self.render)
+
+    def transferred(self, direction, amount):
+        with self.lock:
+            self.bytes[direction] += amount
+
+    def counted(self, chunks, direction):
+        for chunk in chunks:
+            self.transferred(direction, len(chunk))
+            yield chunk
+
+    def log(self, message):
+        # a message from a worker, written by the renderer with the progress
+        with self.lock:
+            self.messages.append(message)
+        self.start_renderer()
+
+    def finish(self, phase):
+        with self.lock:
+            phase.finished = time.monotonic()
+        self.render()
+
+    def render_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.render()
+
+    def render(self):
+        with self.drawing:
+            self.draw()
+
+    def draw(self):
+        # takes everything to draw under the lock, writes outside it
+        now = time.monotonic()
+        with self.lock:
+            messages, self.messages = self.messages, []
+            snapshots = [phase.snapshot(now) for phase in self.active]
+            self.active = [phase for phase in self.active if phase.finished is None]
+        mode, stream = self.output()
+        if mode == "off" or not (messages or snapshots):
+            return
+        if mode == "json":
+            lines = [json.dumps({"event": message}) for message in messages] + [
+                json.dumps(snapshot) for snapshot in snapshots
+            ]
+            stream.write("".join(line + "\n" for line in lines))
+        else:
+            output = "".join(f"\r\x1b[K{message}\n" for message in messages)
+            output += "".join(
+                f"\r\x1b[K{status_line(snapshot)}\n"
+                for snapshot in snapshots
+                if snapshot["finished"]
+            )
+            running = [snapshot for snapshot in snapshots if not snapshot["finished"]]
+            if running:
+                output += "\r\x1b[K" + " | ".join(map(status_line, running))
+            stream.write(output)
+        stream.flush()
+
+
+def status_line(snapshot):
+    line = f"{snapshot['phase']} {snapshot['done']}"
+    if snapshot["total"] is not None:
+        percent = 100 * snapshot["done"] / (snapshot["total"] or 1)
+        line += f"/{snapshot['total']} {percent:.1f}%"
+    line += f" {snapshot['rate']:.1f}/s"
+    if snapshot["bytes"]:
+        line += f" {format_bytes(snapshot['bytes'])} at {format_bytes(snapshot['bytes_rate'])}/s"
+    if snapshot["total"] and not snapshot["finished"] and snapshot["rate"]:
+        remaining = (snapshot["total"] - snapshot["done"]) / snapshot["rate"]
+        line += f" eta {remaining:.0f}s"
+    return line
+
+
+def format_bytes(amount):
+    for unit in ("B", "KB", "MB", "GB"):
+        if amount < 1024:
+            return f"{amount:.0f}{unit}" if unit == "B" else f"{amount:.1f}{unit}"
+        amount /= 1024
+    return f"{amount:.1f}TB"
+
+
+progress = ProgressBus()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import atexit
+import cProfile
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextlib import nullcontext
+from pathlib import Path
+
+# opt-in spans around client calls, hashing and the phases of a run, written
+# out in chrome's trace event format (load the file in chrome://tracing or
+# https://ui.perfetto.dev). while tracing is off a span is a single attribute
+# check returning a shared no-op context manager
+
+NO_SPAN = nullcontext()
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.started = time.perf_counter()
+        self.profile_dir = None
+        self.profiles = 0
+        self.lock = threading.Lock()
+
+    def enable(self, profile_dir=None):
+        self.enabled = True
+        self.events = []
+        self.started = time.perf_counter()
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.profiles = 0
+
+    def disable(self):
+        self.enabled = False
+        self.events = []
+
+    def span(self, name, category="bintray", tid=None, **args):
+        if not self.enabled:
+            return NO_SPAN
+        return self.record(name, category, tid, args)
+
+    @contextmanager
+    def record(self, name, category, tid, args):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            # list.append is atomic, so worker threads can record without a lock
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (started - self.started) * 1e6,
+                    "dur": (time.perf_counter() - started) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": tid if tid is not None else threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def phase(self, name, **args):
+        # a span that is also profiled with cProfile when a profile directory
+        # is set. only for cpu bound work on the calling thread, cProfile
+        # does not see other threads
+        if not self.enabled:
+            return NO_SPAN
+        return self.profiled_phase(name, args)
+
+    @contextmanager
+    def profiled_phase(self, name, args):
+        with self.span(name, "phase", **args):
+            if self.profile_dir is None:
+                yield
+                return
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.profiles += 1
+                    count = self.profiles
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(self.profile_dir / f"{count:03d}-{name}.prof")
+
+    def export(self, path):
+        with open(path, "w") as trace:
+            json.dump({"traceEvents": list(self.events)}, trace)
+
+
+tracer = Tracer()
+
+
+def span_args(args):
+    return {"args": [str(arg)[:200] for arg in args]}
+
+
+def traced(name):
+    # wraps a client method, sync or async, in a span named after the call
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(self, *args, **kwargs):
+                if not tracer.enabled:
+                    return await function(self, *args, **kwargs)
+                # concurrent tasks share a thread, so each task gets its own
+                # track in the timeline
+                with tracer.span(
+                    name, "client", id(asyncio.current_task()), **span_args(args)
+                ):
+                    return await function(self, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            if not tracer.enabled:
+                return function(self, *args, **kwargs)
+            with tracer.span(name, "client", **span_args(args)):
+                return function(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def tracing_from_environment():
+    # BINTRAY_TRACE=trace.json records a trace that is written out when the
+    # script exits, BINTRAY_PROFILE_DIR=dir also dumps a cProfile per phase
+    trace_path = os.environ.get("BINTRAY_TRACE")
+    if not trace_path:
+        return
+    tracer.enable(os.environ.get("BINTRAY_PROFILE_DIR"))
+    atexit.register(tracer.export, trace_path)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import zipfile
+from pathlib import Path
+
+import requests
+
+from .bintray_client import HashingReader
+from .progress import progress
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ArchiveSink:
+    # unseekable file zipfile writes into, emptied every time a chunk of the
+    # archive is handed to the request so at most one chunk is held in memory
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def version_key(path):
+    # local files live at <repo>/<package>/<version>/<path in repository>
+    return tuple(Path(path).parts[:3])
+
+
+def archive_chunks(paths, root, sha1s):
+    # generates the zip of a version directory one chunk at a time, filling
+    # sha1s with the hash of every file as it is read
+    sink = ArchiveSink()
+    with zipfile.ZipFile(sink, mode="w") as archive:
+        for path in paths:
+            name = str(Path(*Path(path).parts[3:]))
+            local_file = root / path
+            info = zipfile.ZipInfo.from_file(local_file, name)
+            # a streamed zip needs data descriptors, which java's zip reader
+            # only accepts on deflated entries
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with local_file.open(mode="rb") as source, archive.open(
+                info, mode="w"
+            ) as entry:
+                reader = HashingReader(source, info.file_size)
+                for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+                    entry.write(chunk)
+                    data = sink.drain()
+                    # an empty chunk would end a chunked request body early
+                    if data:
+                        yield data
+            sha1s[str(path)] = reader.hexdigest()
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def upload_version_archive(bintray_client, paths, root=Path(".")):
+    # uploads every file of one version as a single exploded archive and
+    # returns the paths bintray did not end up with, which need uploading one
+    # at a time
+    repository, package_name, version = version_key(paths[0])
+    sha1s = {}
+    try:
+        bintray_client.upload_archive(
+            repository, package_name, version, archive_chunks(paths, root, sha1s)
+        )
+        uploaded = {
+            f"{repository}/{package_name}/{version}/{bintray_file['path']}": bintray_file[
+                "sha1"
+            ]
+            for bintray_file in bintray_client.get_version_files(
+                repository, package_name, version
+            )
+        }
+    except requests.exceptions.RequestException as e:
+        progress.log(f"bulk upload of {repository}/{package_name}/{version} failed: {e}")
+        return list(paths)
+    return [path for path in paths if uploaded.get(str(path)) != sha1s.get(str(path))]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import pytest
+from httpretty import httpretty
+
+from src.fake_bintray import FakeBintray
+from src.fake_bintray import server_urls
+
+
+@pytest.fixture
+def serve_bintray():
+    # starts a fake bintray with the given options, its urls are kept on it
+    # for the scripts. every server started is stopped after the test
+    httpretty.disable()
+    servers = []
+
+    def serve(*args, **kwargs):
+        bintray = FakeBintray(*args, **kwargs)
+        servers.append(bintray.serve())
+        bintray.urls = server_urls(servers[-1])
+        return bintray
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
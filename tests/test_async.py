@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from aiohttp import web
+from httpretty import httpretty
+
+from src import bintray_async
+from src.backup_manifest import read_manifest
+
+TEST_REPO = "repo-to-sync"
+FILE_BODY = b"1234567890"
+FILE_SHA1 = "01b307acba4f54f55aafc33bb06bbbf6ca803e9a"
+
+
+def fake_bintray(uploads, created_packages, throttle=False):
+    # with throttle every request is answered with a 429 the first time
+    throttled = set()
+
+    @web.middleware
+    async def throttle_first_attempt(request, handler):
+        if throttle and (request.method, request.path) not in throttled:
+            throttled.add((request.method, request.path))
+            await request.read()
+            return web.json_response(
+                {"message": "throttled"}, status=429, headers={"Retry-After": "0"}
+            )
+        return await handler(request)
+
+    async def packages(request):
+        return web.json_response(
+            [{"name": "fake_package"}, {"name": "fake_package_2"}]
+            if request.match_info["organisation"] == "hmrc"
+            else []
+        )
+
+    async def package(request):
+        return web.json_response(
+            {"name": request.match_info["package"], "repo": TEST_REPO}
+        )
+
+    async def files(request):
+        if request.match_info["organisation"] != "hmrc":
+            return web.json_response([])
+        return web.json_response(
+            [
+                {
+                    "path": f"org/{version}/file.jar",
+                    "package": request.match_info["package"],
+                    "version": version,
+                    "repo": TEST_REPO,
+                    "size": len(FILE_BODY),
+                    "sha1": FILE_SHA1,
+                }
+                for version in ["1.0.0", "2.0.0"]
+            ]
+        )
+
+    async def download(request):
+        return web.Response(body=FILE_BODY)
+
+    async def upload(request):
+        uploads[request.match_info["path"]] = await request.read()
+        return web.json_response({})
+
+    async def create_package(request):
+        created_packages.append((await request.json())["name"])
+        return web.json_response({}, status=201)
+
+    app = web.Application(middlewares=[throttle_first_attempt])
+    app.router.add_get(
+        "/api/v1/repos/{organisation}/{repository}/packages", packages
+    )
+    app.router.add_get(
+        "/api/v1/packages/{organisation}/{repository}/{package}/files", files
+    )
+    app.router.add_get(
+        "/api/v1/packages/{organisation}/{repository}/{package}", package
+    )
+    app.router.add_post(
+        "/api/v1/packages/{organisation}/{repository}", create_package
+    )
+    app.router.add_get("/dl/{organisation}/{path:.*}", download)
+    app.router.add_put("/api/v1/content/{organisation}/{path:.*}", upload)
+    return app
+
+
+async def backup_and_restore(root, uploads, created_packages, throttle=False):
+    runner = web.AppRunner(fake_bintray(uploads, created_packages, throttle))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    urls = {
+        "api_url": f"http://127.0.0.1:{port}/api/v1",
+        "dl_url": f"http://127.0.0.1:{port}/dl",
+    }
+    try:
+        await bintray_async.backup(
+            "foo", "bar", "hmrc", [TEST_REPO], root=root, **urls
+        )
+        await bintray_async.restore(
+            "foo", "bar", "hmrc-digital", [TEST_REPO], root=root, **urls
+        )
+    finally:
+        await runner.cleanup()
+
+
+def test_async_backup_and_restore(tmp_path):
+    httpretty.disable()
+    uploads = {}
+    created_packages = []
+
+    asyncio.run(backup_and_restore(tmp_path, uploads, created_packages))
+
+    files, package_metadata = read_manifest(tmp_path)
+    assert len(files) == 4
+    assert (
+        tmp_path / f"{TEST_REPO}/fake_package/1.0.0/org/1.0.0/file.jar"
+    ).read_bytes() == FILE_BODY
+    assert sorted(created_packages) == ["fake_package", "fake_package_2"]
+    assert len(uploads) == 4
+    assert uploads[f"{TEST_REPO}/fake_package_2/2.0.0/org/2.0.0/file.jar"] == FILE_BODY
+
+
+def test_retries_throttled_requests(tmp_path):
+    httpretty.disable()
+    uploads = {}
+    created_packages = []
+
+    asyncio.run(backup_and_restore(tmp_path, uploads, created_packages, throttle=True))
+
+    assert len(read_manifest(tmp_path)[0]) == 4
+    assert sorted(created_packages) == ["fake_package", "fake_package_2"]
+    assert len(uploads) == 4
+    assert uploads[f"{TEST_REPO}/fake_package_2/2.0.0/org/2.0.0/file.jar"] == FILE_BODY
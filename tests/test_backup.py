@@ -1,21 +1,34 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import re
 import shutil
 from pathlib import Path
 
-from src.bintray_backup import backup, get_sha1_hash
+from src.backup_manifest import read_manifest
+from src.bintray_backup import backup, backup_organisations, get_sha1_hash
+from src.fake_bintray import file_content
 
 import pytest
+import requests
 from httpretty import httpretty
 
 TEST_REPO = "repo-to-test"
 
 
+def remove_backup():
+    shutil.rmtree(TEST_REPO, ignore_errors=True)
+    Path("manifest.jsonl").unlink(missing_ok=True)
+
+
 @pytest.fixture
 def cleanup_directory():
+    # backup() writes into the working directory, which is cleared on both
+    # sides of the test so nothing is left behind
     print("cleaning up")
-    shutil.rmtree(TEST_REPO, ignore_errors=True)
+    remove_backup()
+    yield
+    remove_backup()
 
 
 def test_can_download_file():
@@ -88,6 +101,35 @@ def test_detect_existing_files(cleanup_directory):
     ), "running a backup a second time should not redownload files"
 
 
+def test_writes_manifest(cleanup_directory):
+    httpretty.enable(allow_net_connect=False)
+    organisation = "hmrc"
+    httpretty.reset()
+
+    with_packages(organisation)
+    with_package_metadata(organisation)
+    with_package_file_metadata(organisation)
+    with_files(organisation)
+
+    backup("foo", "bar", organisation)
+
+    files, package_metadata = read_manifest(Path("."))
+    assert {package["name"] for package in package_metadata} == {
+        "fake_package",
+        "fake_package_2",
+        "fake_package_3",
+    }
+    assert len(files) == 6
+    assert {
+        "repo": TEST_REPO,
+        "package": "fake_package",
+        "version": "1.0.0",
+        "path": "org/jfrog/powerutils/nutcracker/1.0.0/nutcracker-1.0.0-sources.jar",
+        "size": 10,
+        "sha1": "01b307acba4f54f55aafc33bb06bbbf6ca803e9a",
+    }.items() <= files[0].items()
+
+
 def test_detect_changed_files(cleanup_directory):
     httpretty.enable(allow_net_connect=False)
     organisation = "hmrc"
@@ -109,6 +151,110 @@ def test_detect_changed_files(cleanup_directory):
     ), "running a backup a second time should redownload files if the sha has changed"
 
 
+def test_can_download_all_repositories_of_several_organisations():
+    httpretty.enable(allow_net_connect=False)
+    httpretty.reset()
+    organisations = ["hmrc", "hmrc-digital"]
+    for organisation in organisations:
+        shutil.rmtree(organisation, ignore_errors=True)
+        with_repositories(organisation)
+        with_packages(organisation)
+        with_package_metadata(organisation)
+        with_package_file_metadata(organisation)
+        with_files(organisation)
+
+    backup_organisations(
+        "foo", "bar", organisations, repositories=None, max_requests_per_organisation=2
+    )
+
+    for organisation in organisations:
+        assert Path(
+            f"{organisation}/{TEST_REPO}/fake_package_2/package_metadata.json"
+        ).exists()
+        assert (
+            Path(
+                f"{organisation}/{TEST_REPO}/fake_package_3/2.0.0/org/jfrog/powerutils/nutcracker/2.0.0/nutcracker-2.0.0-sources.jar"
+            ).read_text()
+            == "1234567890"
+        )
+        shutil.rmtree(organisation)
+    assert 2 * 15 == len(httpretty.latest_requests)
+
+
+def test_downloads_start_while_packages_are_still_being_listed(serve_bintray, tmp_path):
+    bintray = serve_bintray("hmrc", packages=20, versions=1, files_per_version=4, latency=0.01)
+    backup_organisations(
+        "user",
+        "token",
+        {"hmrc": tmp_path},
+        ["repository-0"],
+        max_workers=4,
+        **bintray.urls,
+    )
+
+    history = bintray.history
+    last_listing = len(history) - 1 - history[::-1].index("get_package_files")
+    assert history.index("download") < last_listing
+    assert bintray.requests["download"] == 20 * 4
+
+
+def test_fails_at_once_on_a_listed_file_that_cannot_be_downloaded(serve_bintray, tmp_path):
+    bintray = serve_bintray("hmrc", packages=1, versions=1, files_per_version=1)
+    # listed, but the download answers 404
+    bintray.add_file("hmrc", "repository-0", "package-0", "1.0.0", "gone.jar", 3, "0" * 40)
+    with pytest.raises(requests.HTTPError):
+        backup_organisations(
+            "user", "token", {"hmrc": tmp_path}, ["repository-0"], **bintray.urls
+        )
+
+    # the generated file, and a single attempt at gone.jar
+    assert bintray.history.count("download") == 2
+
+
+def test_incremental_backup_only_lists_new_versions(serve_bintray, tmp_path):
+    bintray = serve_bintray("hmrc", packages=3, versions=4, files_per_version=2)
+    options = {"incremental": True, **bintray.urls}
+    backup_organisations("user", "token", {"hmrc": tmp_path}, ["repository-0"], **options)
+    assert bintray.requests["get_package_files"] == 3
+
+    bintray.requests.clear()
+    backup_organisations("user", "token", {"hmrc": tmp_path}, ["repository-0"], **options)
+    assert bintray.requests["get_package"] == 3
+    assert bintray.requests["get_package_files"] == 0
+    assert bintray.requests["get_version_files"] == 0
+    assert bintray.requests["download"] == 0
+
+    bintray.add_file(
+        "hmrc",
+        "repository-0",
+        "package-1",
+        "2.0.0",
+        "uk/gov/hmrc/new.jar",
+        3,
+        hashlib.sha1(file_content("uk/gov/hmrc/new.jar", 3)).hexdigest(),
+        generated=True,
+    )
+    bintray.requests.clear()
+    backup_organisations("user", "token", {"hmrc": tmp_path}, ["repository-0"], **options)
+
+    # the new version, and the version that was newest at the last backup
+    assert bintray.requests["get_version_files"] == 2
+    assert bintray.requests["get_package_files"] == 0
+    assert bintray.requests["download"] == 1
+    files, _ = read_manifest(tmp_path)
+    assert len(files) == 3 * 4 * 2 + 1
+
+
+def with_repositories(organisation):
+    httpretty.register_uri(
+        httpretty.GET,
+        f"https://bintray.com/api/v1/repos/{organisation}/",
+        status=200,
+        adding_headers={"Content-Type": "application/json"},
+        body=json.dumps([{"name": "sbt-plugin-releases", "owner": organisation}]),
+    )
+
+
 def with_files(organisation):
     httpretty.register_uri(
         httpretty.GET,
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+from src.bandwidth import BandwidthLimiter
+from src.bandwidth import ThrottledReader
+from src.bandwidth import TokenBucket
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket()
+
+    assert bucket.reserve(10 ** 9) == 0
+
+
+def test_bucket_makes_callers_wait_for_their_share():
+    bucket = TokenBucket(rate=100)
+
+    assert bucket.reserve(50) == pytest.approx(0.5, abs=0.05)
+    assert bucket.reserve(50) == pytest.approx(1.0, abs=0.05)
+
+
+def test_bucket_rate_can_change_during_a_run():
+    bucket = TokenBucket(rate=100)
+    bucket.reserve(100)
+
+    bucket.set_rate(1000)
+    assert bucket.reserve(100) == pytest.approx(0.2, abs=0.05)
+
+    bucket.set_rate(None)
+    assert bucket.reserve(100) == 0
+
+
+def test_rejects_a_rate_of_zero():
+    bucket = TokenBucket(rate=100)
+    limiter = BandwidthLimiter(100, 100)
+
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+    with pytest.raises(ValueError):
+        bucket.set_rate(0)
+    with pytest.raises(ValueError):
+        limiter.set_rates(1000, 0)
+    # a rejected rate leaves the limits as they were
+    assert bucket.rate == 100
+    assert limiter.ingress.rate == 100
+
+
+def test_throttled_reader_takes_reads_from_the_bucket():
+    bucket = TokenBucket(rate=1000)
+    reader = ThrottledReader(io.BytesIO(b"1234567890"), 10, bucket)
+
+    assert len(reader) == 10
+    assert reader.read(4) == b"1234"
+    # the 4 bytes read are already owed, so 996 more is a full second
+    assert bucket.reserve(996) == pytest.approx(1.0, abs=0.05)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
+import threading
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+from src.bintray_client import iter_json_array
+from src.bintray_client import stream_on_thread
+from src.bintray_client import HashingReader
+from src.bintray_client import BintrayClient
+
+LISTING = [
+    {"path": "uk/gov/hmrc/é.jar", "size": 1234567, "sha1": "a" * 40},
+    {"path": "uk/gov/hmrc/b.jar", "size": 7, "labels": ["x", {"y": None}]},
+    12.5,
+]
+
+
+def test_parses_a_listing_split_anywhere():
+    body = json.dumps(LISTING).encode()
+
+    for size in range(1, 8):
+        chunks = (body[i : i + size] for i in range(0, len(body), size))
+        assert list(iter_json_array(chunks)) == LISTING
+
+
+def test_parses_items_before_the_rest_of_the_listing_arrives():
+    items = iter_json_array(iter([b'[{"path": "a"}, {"pa', b'th": "b"}]']))
+
+    assert next(items) == {"path": "a"}
+    assert next(items) == {"path": "b"}
+
+
+def test_rejects_a_truncated_listing():
+    with pytest.raises(ValueError):
+        list(iter_json_array(iter([b'[{"path": "a"}, {"pa'])))
+
+
+def test_reads_no_more_than_the_size_it_was_given():
+    # the file grew after its size was taken
+    reader = HashingReader(io.BytesIO(b"1234567890 and more"), 10)
+
+    assert reader.read(4) == b"1234"
+    assert reader.read() == b"567890"
+    assert reader.read(4) == b""
+    assert reader.hexdigest() == hashlib.sha1(b"1234567890").hexdigest()
+
+
+def test_hands_over_records_before_the_listing_ends():
+    first_record_taken = threading.Event()
+
+    def listing():
+        yield {"path": "a"}
+        # only reached if "a" was handed over while the listing was going
+        assert first_record_taken.wait(5)
+        yield {"path": "b"}
+
+    records = stream_on_thread(listing())
+    assert next(records) == {"path": "a"}
+    first_record_taken.set()
+    assert list(records) == [{"path": "b"}]
+
+
+def test_yields_packages_as_they_are_fetched(serve_bintray):
+    bintray = serve_bintray("hmrc", packages=3, versions=2, files_per_version=2)
+    client = BintrayClient(
+        "hmrc", api_creds=requests.auth.HTTPBasicAuth("user", "token"), **bintray.urls
+    )
+
+    packages = client.iter_metadata(["repository-0"])
+    information, files = next(packages)
+    assert bintray.requests["get_package"] == 1
+    assert information["name"] == "package-0"
+    assert len(files) == 4
+    assert [information["name"] for information, _ in packages] == [
+        "package-1",
+        "package-2",
+    ]
+
+
+def test_backs_off_a_throttled_upload_a_bounded_number_of_times(serve_bintray, tmp_path):
+    bintray = serve_bintray("hmrc", packages=1, throttle_rate=1.0)
+    client = BintrayClient(
+        "hmrc", api_creds=requests.auth.HTTPBasicAuth("user", "token"), **bintray.urls
+    )
+    path = Path("repository-0/package-0/1.0.0/a.jar")
+    (tmp_path / path).parent.mkdir(parents=True)
+    (tmp_path / path).write_bytes(b"a")
+    started = time.monotonic()
+    with pytest.raises(requests.HTTPError):
+        client.upload_file(path, local_root=tmp_path)
+
+    assert bintray.requests["upload"] == 5
+    # each retry waited for the Retry-After of 0.1 seconds
+    assert time.monotonic() - started >= 0.4
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from httpretty import httpretty
+
+from src import load_runner
+
+
+def test_backup_and_restore_survive_errors_and_throttling(monkeypatch):
+    httpretty.disable()
+    destinations = []
+    fake_bintray = load_runner.FakeBintray
+
+    def remember_fake_bintray(*args, **kwargs):
+        destinations.append(fake_bintray(*args, **kwargs))
+        return destinations[-1]
+
+    monkeypatch.setattr(load_runner, "FakeBintray", remember_fake_bintray)
+
+    report = load_runner.run(
+        packages=3,
+        versions=2,
+        files_per_version=3,
+        error_rate=0.05,
+        throttle_rate=0.05,
+        max_workers=4,
+    )
+
+    assert report["files"] == 18
+    organisations = destinations[0].organisations
+    source = organisations[load_runner.SOURCE]["repository-0"]
+    destination = organisations[load_runner.DESTINATION]["repository-0"]
+    assert sorted(destination) == sorted(source)
+    for name, package in source.items():
+        assert {
+            path: file["sha1"] for path, file in destination[name]["files"].items()
+        } == {path: file["sha1"] for path, file in package["files"].items()}
+
+
+def test_bulk_restore_uploads_one_archive_per_version():
+    httpretty.disable()
+
+    report = load_runner.run(packages=2, versions=2, files_per_version=3, bulk=True)
+
+    assert report["requests"]["upload"] == 4
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+import pytest
+from httpretty import httpretty
+from tenacity import wait_none
+
+from src.bintray_client import ChecksumMismatch
+from src.bintray_client import MAX_REQUEST_ATTEMPTS
+from src.bintray_mirror import mirror
+from src.bintray_mirror import mirror_file
+
+TEST_REPO = "repo-to-mirror"
+SOURCE = "hmrc"
+DESTINATION = "hmrc-digital"
+
+
+def test_mirrors_changed_files_without_touching_disk():
+    httpretty.enable(allow_net_connect=False)
+    httpretty.reset()
+
+    with_packages(SOURCE, ["fake_package", "fake_package_2"])
+    with_packages(DESTINATION, ["fake_package"])
+    with_package(SOURCE, "fake_package", "01b307acba4f54f55aafc33bb06bbbf6ca803e9a")
+    with_package(SOURCE, "fake_package_2", "01b307acba4f54f55aafc33bb06bbbf6ca803e9a")
+    with_package(DESTINATION, "fake_package", "thisisthewronghash")
+    with_files(SOURCE)
+    with_create_packages(DESTINATION)
+    with_file_upload(DESTINATION)
+    with_publish(DESTINATION)
+
+    # one worker, httpretty cannot record concurrent request bodies
+    mirror("foo", "bar", SOURCE, DESTINATION, repositories=[TEST_REPO], max_workers=1)
+
+    created = [
+        json.loads(request.body)["name"]
+        for request in httpretty.latest_requests
+        if request.method == httpretty.POST and "/packages/" in request.path
+    ]
+    assert created == ["fake_package_2"]
+    uploads = [
+        request
+        for request in httpretty.latest_requests
+        if request.method == httpretty.PUT
+    ]
+    assert sorted(upload.path for upload in uploads) == [
+        f"/api/v1/content/{DESTINATION}/{TEST_REPO}/fake_package/1.0.0/foo.jar?publish=0&override=1",
+        f"/api/v1/content/{DESTINATION}/{TEST_REPO}/fake_package_2/1.0.0/foo.jar?publish=0&override=1",
+    ]
+    assert all(upload.body == b"1234567890" for upload in uploads)
+    assert all(upload.headers["Content-Length"] == "10" for upload in uploads)
+    # each copy is published once its sha1 has been checked
+    published = [
+        request.path
+        for request in httpretty.latest_requests
+        if request.method == httpretty.POST and request.path.endswith("/publish")
+    ]
+    assert sorted(published) == [
+        f"/api/v1/content/{DESTINATION}/{TEST_REPO}/fake_package/1.0.0/publish",
+        f"/api/v1/content/{DESTINATION}/{TEST_REPO}/fake_package_2/1.0.0/publish",
+    ]
+
+
+def test_publishes_each_version_once(serve_bintray):
+    bintray = serve_bintray(SOURCE, packages=2, versions=3, files_per_version=4)
+    mirror(
+        "foo",
+        "bar",
+        SOURCE,
+        DESTINATION,
+        repositories=["repository-0"],
+        max_workers=4,
+        **bintray.urls,
+    )
+
+    assert bintray.requests["publish"] == 2 * 3
+    destination = bintray.repository(DESTINATION, "repository-0")
+    files = [file for package in destination.values() for file in package["files"].values()]
+    assert len(files) == 2 * 3 * 4
+    assert all(file["published"] for file in files)
+
+
+def test_deletes_a_corrupted_copy_instead_of_publishing_it(serve_bintray, monkeypatch):
+    monkeypatch.setattr(mirror_file.retry, "wait", wait_none())
+    bintray = serve_bintray(SOURCE, packages=1, versions=1, files_per_version=1)
+    # the listing's sha1 does not match what is downloaded
+    bintray.add_file(
+        SOURCE, "repository-0", "package-0", "1.0.0", "bad.jar", 10, "0" * 40, generated=True
+    )
+    with pytest.raises(ChecksumMismatch):
+        mirror(
+            "foo",
+            "bar",
+            SOURCE,
+            DESTINATION,
+            repositories=["repository-0"],
+            max_workers=1,
+            **bintray.urls,
+        )
+
+    files = bintray.repository(DESTINATION, "repository-0")["package-0"]["files"]
+    assert "bad.jar" not in files
+    assert all(file["published"] for file in files.values())
+    # every attempt deleted its copy, and gave up after a bounded number
+    assert bintray.requests["delete_file"] == MAX_REQUEST_ATTEMPTS
+
+
+def with_packages(organisation, package_names):
+    httpretty.register_uri(
+        httpretty.GET,
+        f"https://bintray.com/api/v1/repos/{organisation}/{TEST_REPO}/packages?start_pos=0",
+        match_querystring=True,
+        status=200,
+        adding_headers={"Content-Type": "application/json"},
+        body=json.dumps([{"name": name, "linked": False} for name in package_names]),
+    )
+
+
+def with_package(organisation, package_name, sha1):
+    httpretty.register_uri(
+        httpretty.GET,
+        f"https://bintray.com/api/v1/packages/{organisation}/{TEST_REPO}/{package_name}",
+        status=200,
+        adding_headers={"Content-Type": "application/json"},
+        body=json.dumps({"name": package_name, "repo": TEST_REPO}),
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        f"https://bintray.com/api/v1/packages/{organisation}/{TEST_REPO}/{package_name}/files",
+        status=200,
+        adding_headers={"Content-Type": "application/json"},
+        body=json.dumps(
+            [
+                {
+                    "name": "foo.jar",
+                    "path": "foo.jar",
+                    "package": package_name,
+                    "version": "1.0.0",
+                    "repo": TEST_REPO,
+                    "owner": organisation,
+                    "size": 10,
+                    "sha1": sha1,
+                }
+            ]
+        ),
+    )
+
+
+def with_files(organisation):
+    httpretty.register_uri(
+        httpretty.GET,
+        re.compile(f"https://dl.bintray.com/{organisation}/.*"),
+        status=200,
+        body="1234567890",
+    )
+
+
+def with_create_packages(organisation):
+    httpretty.register_uri(
+        httpretty.POST,
+        f"https://bintray.com/api/v1/packages/{organisation}/{TEST_REPO}",
+        status=201,
+        adding_headers={"Content-Type": "application/json"},
+        body=json.dumps({}),
+    )
+
+
+def with_file_upload(organisation):
+    httpretty.register_uri(
+        httpretty.PUT,
+        re.compile(f"https://bintray.com/api/v1/content/{organisation}/{TEST_REPO}/.*"),
+        status=200,
+        body="{}",
+    )
+
+
+def with_publish(organisation):
+    httpretty.register_uri(
+        httpretty.POST,
+        re.compile(f"https://bintray.com/api/v1/content/{organisation}/{TEST_REPO}/.*"),
+        status=200,
+        body="{}",
+    )
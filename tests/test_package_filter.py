@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+
+import pytest
+
+from src.backup_manifest import read_manifest
+from src.bintray_backup import backup_organisations
+from src.bintray_restore import restore_organisations
+from src.package_filter import PackageFilter
+from src.package_filter import package_filter_from_environment
+from src.package_filter import select_local_files
+
+
+@pytest.fixture
+def bintray(serve_bintray):
+    return serve_bintray("hmrc", packages=4, versions=3, files_per_version=2)
+
+
+def test_filters_packages_versions_and_dates():
+    package_filter = PackageFilter(
+        include=["play-*"],
+        exclude=["play-test*"],
+        versions=">=1.9.0,<2.0.0",
+        updated_since="2020-06-01",
+    )
+
+    assert package_filter.includes_package("play-json")
+    assert not package_filter.includes_package("play-test-utils")
+    assert not package_filter.includes_package("sbt-auto-build")
+    assert package_filter.includes_version("1.10.0")
+    assert not package_filter.includes_version("1.8.2")
+    assert not package_filter.includes_version("2.0.0")
+    assert PackageFilter(versions="1.2.*").includes_version("1.2.7")
+    assert package_filter.includes_updated({"updated": "2020-12-01T00:00:00.000Z"})
+    assert not package_filter.includes_updated({"updated": "2019-12-01T00:00:00.000Z"})
+    assert package_filter.ignoring_dates().includes_updated({"updated": "2019-12-01"})
+
+
+def test_selects_local_files():
+    local_files = [
+        Path("releases/play-json/1.0.0/a.jar"),
+        Path("releases/play-json/2.0.0/a.jar"),
+        Path("releases/old-lib/1.0.0/a.jar"),
+        Path("releases/.DS_Store"),
+        Path("releases/play-json/.DS_Store"),
+    ]
+    local_package_metadata = [
+        {"repo": "releases", "name": "play-json", "updated": "2020-12-01"},
+        {"repo": "releases", "name": "old-lib", "updated": "2019-12-01"},
+    ]
+
+    files, package_metadata = select_local_files(
+        local_files,
+        local_package_metadata,
+        PackageFilter(versions="<2.0.0", updated_since="2020-06-01"),
+    )
+
+    assert files == [Path("releases/play-json/1.0.0/a.jar")]
+    assert [package["name"] for package in package_metadata] == ["play-json"]
+
+
+def test_no_filter_from_an_empty_environment(monkeypatch):
+    for name in (
+        "BINTRAY_INCLUDE_PACKAGES",
+        "BINTRAY_EXCLUDE_PACKAGES",
+        "BINTRAY_VERSIONS",
+        "BINTRAY_UPDATED_SINCE",
+    ):
+        monkeypatch.delenv(name, raising=False)
+
+    assert package_filter_from_environment() is None
+
+    monkeypatch.setenv("BINTRAY_VERSIONS", "<2.0.0")
+    assert package_filter_from_environment().filters_versions
+
+
+def test_filtered_backup_only_crawls_what_it_keeps(bintray, tmp_path):
+    backup_organisations(
+        "user",
+        "token",
+        {"hmrc": tmp_path},
+        ["repository-0"],
+        package_filter=PackageFilter(
+            include=["package-1", "package-2"], versions="1.1.0"
+        ),
+        **bintray.urls,
+    )
+
+    assert bintray.requests["get_package"] == 2
+    assert bintray.requests["get_package_files"] == 0
+    assert bintray.requests["get_version_files"] == 2
+    assert bintray.requests["download"] == 4
+    files, package_metadata = read_manifest(tmp_path)
+    assert sorted((file["package"], file["version"]) for file in files) == [
+        ("package-1", "1.1.0"),
+        ("package-1", "1.1.0"),
+        ("package-2", "1.1.0"),
+        ("package-2", "1.1.0"),
+    ]
+
+    # a second filtered backup keeps what the first one recorded
+    backup_organisations(
+        "user",
+        "token",
+        {"hmrc": tmp_path},
+        ["repository-0"],
+        package_filter=PackageFilter(include=["package-1"], versions="1.0.0"),
+        **bintray.urls,
+    )
+
+    files, package_metadata = read_manifest(tmp_path)
+    assert len(files) == 6
+    assert sorted(package["name"] for package in package_metadata) == [
+        "package-1",
+        "package-2",
+    ]
+
+
+def test_filtered_restore(bintray, tmp_path):
+    backup_organisations(
+        "user", "token", {"hmrc": tmp_path}, ["repository-0"], **bintray.urls
+    )
+
+    restore_organisations(
+        "user",
+        "token",
+        {"hmrc-digital": tmp_path},
+        ["repository-0"],
+        package_filter=PackageFilter(exclude=["package-0"], versions=">=1.2.0"),
+        **bintray.urls,
+    )
+
+    restored = bintray.organisations["hmrc-digital"]["repository-0"]
+    assert sorted(restored) == ["package-1", "package-2", "package-3"]
+    assert {
+        file["version"] for package in restored.values() for file in package["files"].values()
+    } == {"1.2.0"}
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from src.progress import ProgressBus
+
+
+def progress_bus(mode):
+    bus = ProgressBus()
+    output = io.StringIO()
+    # the renderer does not get a turn, each test draws when it wants to
+    bus.configure(mode, output, interval=3600)
+    return bus, output
+
+
+def test_workers_post_counters_that_are_written_as_json_lines():
+    bus, output = progress_bus("json")
+
+    with bus.phase("Downloading files", 100, "in") as phase:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for _ in executor.map(
+                lambda _: (phase.next(), bus.transferred("in", 1024)), range(100)
+            ):
+                pass
+        bus.log("listed 100 packages")
+        assert output.getvalue() == ""
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert lines[0] == {"event": "listed 100 packages"}
+    assert lines[1]["phase"] == "Downloading files"
+    assert lines[1]["done"] == 100
+    assert lines[1]["total"] == 100
+    assert lines[1]["bytes"] == 100 * 1024
+    assert lines[1]["finished"]
+
+
+def test_redraws_a_status_line_on_a_terminal():
+    bus, output = progress_bus("tty")
+
+    uploads = bus.phase("Uploading files", 4, "out")
+    for _ in uploads.iter(range(2)):
+        pass
+    crawl = bus.phase("Downloading package information", 10)
+    crawl.next(5)
+    bus.render()
+
+    assert output.getvalue().startswith("\r\x1b[KUploading files 2/4 50.0%")
+    assert not output.getvalue().endswith("\n")
+    assert "\r\x1b[KDownloading package information 5/10 50.0%" in output.getvalue()
+
+
+def test_off_writes_nothing():
+    bus, output = progress_bus("off")
+
+    with bus.phase("Mirroring files", 1) as phase:
+        phase.next()
+
+    assert output.getvalue() == ""
@@ -1,14 +1,26 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import io
 import json
 import re
 import shutil
+import zipfile
 from pathlib import Path
 
 import pytest
+import requests
 from httpretty import httpretty
 
+from src.backup_manifest import read_manifest
+from src.backup_manifest import write_manifest
+from src.bintray_client import BintrayClient
+from src.bintray_client import CHUNK_SIZE
+from src.bintray_restore import create_new_packages
 from src.bintray_restore import get_local_files
+from src.bintray_restore import get_local_sha1s
+from src.bintray_restore import is_changed
 from src.bintray_restore import restore
+from src.version_archive import archive_chunks
 
 TEST_REPO = "repo-to-check"
 
@@ -84,6 +96,112 @@ def test_discover_local_files(test_repo):
            } in packages
     assert len(packages) == 4
 
+def test_discover_local_files_from_manifest():
+    local_file = Path(TEST_REPO, "fake_package/0.0.1/this/is/my/path/foo.txt")
+    local_file.parent.mkdir(parents=True, exist_ok=True)
+    local_file.write_text("this is a test file")
+    write_manifest(
+        TEST_REPO,
+        {TEST_REPO, "other-repo"},
+        [
+            {
+                "repo": TEST_REPO,
+                "package": "fake_package",
+                "version": "0.0.1",
+                "path": "this/is/my/path/foo.txt",
+                "size": 19,
+                "sha1": "5d03965084a5db13c178cbb1ffc120b360353685",
+                "mtime_ns": 0,
+            },
+            {
+                "repo": TEST_REPO,
+                "package": "fake_package",
+                "version": "0.0.1",
+                "path": "this/is/my/path/deleted.txt",
+                "size": 19,
+                "sha1": "5d03965084a5db13c178cbb1ffc120b360353685",
+                "mtime_ns": 0,
+            },
+            {
+                "repo": "other-repo",
+                "package": "fake_package",
+                "version": "0.0.1",
+                "path": "this/is/my/path/foo.txt",
+                "size": 19,
+                "sha1": "5d03965084a5db13c178cbb1ffc120b360353685",
+                "mtime_ns": 0,
+            },
+        ],
+        [{"name": "fake_package", "repo": TEST_REPO}],
+    )
+
+    file_paths, packages = get_local_files(
+        [TEST_REPO], Path("."), read_manifest(TEST_REPO)
+    )
+    shutil.rmtree(TEST_REPO)
+
+    assert file_paths == [Path(f"{TEST_REPO}/fake_package/0.0.1/this/is/my/path/foo.txt")]
+    assert packages == [{"name": "fake_package", "repo": TEST_REPO}]
+
+
+def test_hashes_files_edited_since_the_backup(tmp_path):
+    unchanged = tmp_path / "repo" / "package" / "1.0.0" / "a.jar"
+    edited = unchanged.with_name("b.jar")
+    unchanged.parent.mkdir(parents=True)
+    unchanged.write_bytes(b"a")
+    edited.write_bytes(b"b")
+    records = [
+        {
+            "repo": "repo",
+            "package": "package",
+            "version": "1.0.0",
+            "path": path.name,
+            "size": path.stat().st_size,
+            "sha1": "0" * 40,
+            "mtime_ns": path.stat().st_mtime_ns,
+        }
+        for path in (unchanged, edited)
+    ]
+    edited.write_bytes(b"edited")
+
+    local_sha1s = get_local_sha1s(tmp_path, (records, []))
+
+    assert local_sha1s == {"repo/package/1.0.0/a.jar": "0" * 40}
+    assert is_changed(
+        Path("repo/package/1.0.0/b.jar"),
+        {"repo/package/1.0.0/b.jar": "0" * 40},
+        tmp_path,
+        local_sha1s,
+    )
+
+
+def test_creates_a_package_missing_from_one_of_its_repositories(serve_bintray):
+    bintray = serve_bintray("hmrc-digital", packages=1, versions=1, files_per_version=1)
+    client = BintrayClient(
+        "hmrc-digital",
+        api_creds=requests.auth.HTTPBasicAuth("user", "token"),
+        **bintray.urls,
+    )
+    create_new_packages(
+        client,
+        [
+            {"name": "package-0", "repo": "repository-0"},
+            {"name": "package-0", "repo": "repository-1"},
+        ],
+        [{"name": "package-0", "repo": "repository-0"}],
+    )
+
+    assert bintray.requests["create_package"] == 1
+    assert "package-0" in bintray.repository("hmrc-digital", "repository-1")
+
+
+def test_does_not_retry_uploading_a_missing_file(tmp_path):
+    client = BintrayClient("hmrc-digital", api_creds=None)
+
+    with pytest.raises(FileNotFoundError):
+        client.upload_file(Path("repo/package/1.0.0/a.jar"), local_root=tmp_path)
+
+
 def test_restores_files(test_repo):
     organisation = "hmrc-digital"
     httpretty.enable(allow_net_connect=False)
@@ -100,6 +218,9 @@ def test_restores_files(test_repo):
         token="hdiasjnhd",
         organisation=organisation,
         repositories=[TEST_REPO],
+        # httpretty records request bodies against whichever request it saw
+        # last, so requests with bodies have to be made one at a time
+        max_workers=1,
     )
 
     assert len(package_created_requests(httpretty, organisation)) == 2
@@ -145,6 +266,95 @@ def test_restores_files(test_repo):
     assert uploads[1].body == b"this is a test file"
 
 
+def test_uploads_stream_from_the_file(tmp_path):
+    class Session:
+        def request(self, method, url, auth=None, data=None, **kwargs):
+            self.content_length = len(data)
+            self.reads = list(iter(lambda: data.read(CHUNK_SIZE), b""))
+            response = requests.Response()
+            response.status_code = 201
+            return response
+
+    (tmp_path / "big.jar").write_bytes(b"x" * (CHUNK_SIZE * 3 + 1))
+    session = Session()
+    client = BintrayClient("hmrc-digital", api_creds=None, session=session)
+
+    sha1 = client.upload_file(Path("big.jar"), local_root=tmp_path)
+
+    assert session.content_length == CHUNK_SIZE * 3 + 1
+    assert [len(read) for read in session.reads] == [CHUNK_SIZE] * 3 + [1]
+    assert sha1 == hashlib.sha1(b"x" * (CHUNK_SIZE * 3 + 1)).hexdigest()
+
+
+def test_archives_version_files():
+    create_local_package("fake_package")
+    Path(f"{TEST_REPO}/fake_package/0.0.1/this/is/my/path/bar.txt").write_text("bar")
+    paths = [
+        Path(f"{TEST_REPO}/fake_package/0.0.1/this/is/my/path/foo.txt"),
+        Path(f"{TEST_REPO}/fake_package/0.0.1/this/is/my/path/bar.txt"),
+    ]
+    sha1s = {}
+
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(archive_chunks(paths, Path("."), sha1s))))
+    shutil.rmtree(TEST_REPO)
+
+    assert archive.read("this/is/my/path/foo.txt") == b"this is a test file"
+    assert archive.read("this/is/my/path/bar.txt") == b"bar"
+    assert sha1s[str(paths[0])] == "5d03965084a5db13c178cbb1ffc120b360353685"
+
+
+def test_restores_versions_as_archives():
+    organisation = "hmrc-digital"
+    create_local_package("fake_package")
+    Path(f"{TEST_REPO}/fake_package/0.0.1/this/is/my/path/bar.txt").write_text("bar")
+    httpretty.enable(allow_net_connect=False)
+    httpretty.reset()
+
+    httpretty.register_uri(
+        httpretty.GET,
+        f"https://bintray.com/api/v1/repos/{organisation}/{TEST_REPO}/packages?start_pos=0",
+        match_querystring=True,
+        status=200,
+        adding_headers={"Content-Type": "application/json"},
+        body=json.dumps([]),
+    )
+    # only one of the two files made it out of the archive
+    httpretty.register_uri(
+        httpretty.GET,
+        f"https://bintray.com/api/v1/packages/{organisation}/{TEST_REPO}/fake_package/versions/0.0.1/files",
+        status=200,
+        adding_headers={"Content-Type": "application/json"},
+        body=json.dumps(
+            [
+                {
+                    "path": "this/is/my/path/foo.txt",
+                    "package": "fake_package",
+                    "version": "0.0.1",
+                    "repo": TEST_REPO,
+                    "sha1": "5d03965084a5db13c178cbb1ffc120b360353685",
+                }
+            ]
+        ),
+    )
+    with_create_packages(organisation)
+    with_file_upload(organisation)
+
+    restore(
+        username="hdjisand",
+        token="hdiasjnhd",
+        organisation=organisation,
+        repositories=[TEST_REPO],
+        max_workers=1,
+        bulk=True,
+    )
+    shutil.rmtree(TEST_REPO)
+
+    assert [upload.path for upload in file_uploaded_requests(httpretty)] == [
+        "/api/v1/content/hmrc-digital/repo-to-check/fake_package/0.0.1/0.0.1.zip?publish=1&override=1&explode=1",
+        "/api/v1/content/hmrc-digital/repo-to-check/fake_package/0.0.1/this/is/my/path/bar.txt?publish=1&override=1",
+    ]
+
+
 def test_that_upload_fails_when_no_local_files_exist():
     organisation = "hmrc-digital"
     httpretty.enable(allow_net_connect=False)
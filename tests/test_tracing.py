@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+from httpretty import httpretty
+
+from src import load_runner
+from src.bintray_mirror import mirror
+from src.tracing import tracer
+from src.tracing import traced
+from src.tracing import NO_SPAN
+
+
+@pytest.fixture
+def tracing():
+    yield tracer
+    tracer.disable()
+
+
+class Client:
+    @traced("fetch")
+    def fetch(self, path):
+        return path
+
+
+def test_spans_are_free_while_tracing_is_off():
+    assert tracer.span("crawl") is NO_SPAN
+    assert tracer.phase("scan") is NO_SPAN
+    assert Client().fetch("a/b") == "a/b"
+    assert tracer.events == []
+
+
+def test_exports_a_chrome_trace(tracing, tmp_path):
+    tracing.enable(tmp_path / "profiles")
+
+    with tracing.phase("scan"):
+        Client().fetch("a/b")
+    tracing.export(tmp_path / "trace.json")
+
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [(event["name"], event["ph"]) for event in events] == [
+        ("fetch", "X"),
+        ("scan", "X"),
+    ]
+    assert events[0]["args"] == {"args": ["a/b"]}
+    assert events[1]["dur"] >= events[0]["dur"]
+    assert [path.name for path in (tmp_path / "profiles").iterdir()] == [
+        "001-scan.prof"
+    ]
+
+
+def test_traces_the_phases_of_a_restore(tracing):
+    httpretty.disable()
+    tracing.enable()
+
+    load_runner.run(packages=2, versions=1, files_per_version=2)
+
+    names = {event["name"] for event in tracing.events}
+    assert {"crawl", "download", "write", "scan", "create", "upload"} <= names
+    assert {"get_package_names", "download_file", "upload_file", "diff"} <= names
+
+
+def test_traces_the_phases_of_a_mirror(serve_bintray, tracing):
+    tracing.enable()
+    bintray = serve_bintray("hmrc", packages=2, versions=1, files_per_version=2)
+    mirror("user", "token", "hmrc", "hmrc-digital", ["repository-0"], **bintray.urls)
+
+    names = {event["name"] for event in tracing.events}
+    assert {"crawl", "mirror", "create", "publish_version"} <= names
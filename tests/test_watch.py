@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import threading
+import time
+
+import pytest
+import requests
+
+from src.bintray_backup import backup_organisations
+from src.bintray_client import BintrayClient
+from src.bintray_watch import watch
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is linux only"
+)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize("metadata_first", [True, False])
+def test_restores_files_as_they_are_written(serve_bintray, tmp_path, metadata_first):
+    bintray = serve_bintray("hmrc", packages=2, versions=1, files_per_version=2)
+    urls = bintray.urls
+    backup_organisations("user", "token", {"hmrc": tmp_path}, ["repository-0"], **urls)
+    destination = bintray.repository("hmrc-digital", "repository-0")
+    stop = threading.Event()
+    watcher = threading.Thread(
+        target=watch,
+        args=("user", "token", "hmrc-digital", ["repository-0"], tmp_path),
+        kwargs={"settle": 0.1, "stop": stop, **urls},
+    )
+    watcher.start()
+    try:
+        # the files already in the backup are caught up with first
+        wait_for(lambda: sum(len(package["files"]) for package in destination.values()) == 4)
+        crawls = bintray.requests["get_packages"]
+
+        package_dir = tmp_path / "repository-0" / "new-package"
+        (package_dir / "2.0.0" / "uk" / "gov").mkdir(parents=True)
+        metadata = json.dumps({"name": "new-package", "desc": "arrived later"})
+        if metadata_first:
+            (package_dir / "package_metadata.json").write_text(metadata)
+        (package_dir / "2.0.0" / "uk" / "gov" / "new.jar").write_bytes(b"new")
+        if not metadata_first:
+            # long enough for the file to have settled and been looked at
+            time.sleep(0.5)
+            (package_dir / "package_metadata.json").write_text(metadata)
+        wait_for(lambda: "new-package" in destination and destination["new-package"]["files"])
+    finally:
+        stop.set()
+        watcher.join()
+
+    assert destination["new-package"]["information"]["desc"] == "arrived later"
+    assert list(destination["new-package"]["files"]) == ["uk/gov/new.jar"]
+    assert bintray.requests["create_package"] == 3
+    # nothing is crawled again once the watch has started
+    assert bintray.requests["get_packages"] == crawls
+
+
+def test_retries_a_failed_upload(serve_bintray, tmp_path, monkeypatch):
+    bintray = serve_bintray("hmrc", packages=1, versions=1, files_per_version=1)
+    urls = bintray.urls
+    backup_organisations("user", "token", {"hmrc": tmp_path}, ["repository-0"], **urls)
+    destination = bintray.repository("hmrc-digital", "repository-0")
+    upload_file = BintrayClient.upload_file
+    attempts = []
+
+    def fail_first(self, *args, **kwargs):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise requests.ConnectionError("connection reset")
+        return upload_file(self, *args, **kwargs)
+
+    monkeypatch.setattr(BintrayClient, "upload_file", fail_first)
+    stop = threading.Event()
+    watcher = threading.Thread(
+        target=watch,
+        args=("user", "token", "hmrc-digital", ["repository-0"], tmp_path),
+        kwargs={"settle": 0.1, "stop": stop, **urls},
+    )
+    watcher.start()
+    try:
+        # the file is not written again, the failure alone puts it back
+        wait_for(lambda: destination.get("package-0", {}).get("files"))
+    finally:
+        stop.set()
+        watcher.join()
+
+    assert len(attempts) == 2